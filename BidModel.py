@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Created by: Vincentzyx
 import os
+import numpy as np
 import torch
 from torch import nn
 from torch.utils.data import DataLoader
@@ -9,24 +10,35 @@ import time
 import torch.nn.functional as F
 
 
+Env2IdxArray = np.zeros(31, dtype=np.int64)
+for card, idx in {3:0,4:1,5:2,6:3,7:4,8:5,9:6,10:7,11:8,12:9,13:10,14:11,17:12,20:13,30:14}.items():
+    Env2IdxArray[card] = idx
+
+Real2IdxMap = {'3': 0, '4': 1, '5': 2, '6': 3, '7': 4,
+               '8': 5, '9': 6, 'T': 7, 'J': 8, 'Q': 9,
+               'K': 10, 'A': 11, '2': 12, 'X': 13, 'D': 14}
+
+
+def IdxToOnehotBatch(hands):
+    """
+    A list of hands given as card indices (0-14, any number of cards
+    each) to (N, 60) flattened one-hot tensors: row r of the (4, 15)
+    block of a card is set if the hand holds more than r of it.
+    """
+    num_hands = len(hands)
+    rows = np.repeat(np.arange(num_hands), [len(hand) for hand in hands])
+    idx = np.concatenate([np.asarray(hand, dtype=np.int64) for hand in hands] + [np.zeros(0, dtype=np.int64)])
+    counts = np.bincount(idx + 15 * rows, minlength=15 * num_hands).reshape(num_hands, 1, 15)
+    onehot = np.arange(4)[np.newaxis, :, np.newaxis] < counts
+    return torch.from_numpy(onehot.reshape(num_hands, 60).astype(np.float32))
+
+
 def EnvToOnehot(cards):
-    Env2IdxMap = {3:0,4:1,5:2,6:3,7:4,8:5,9:6,10:7,11:8,12:9,13:10,14:11,17:12,20:13,30:14}
-    cards = [Env2IdxMap[i] for i in cards]
-    Onehot = torch.zeros((4,15))
-    for i in range(0, 15):
-        Onehot[:cards.count(i),i] = 1
-    return Onehot
+    return IdxToOnehotBatch([Env2IdxArray[np.asarray(cards, dtype=np.int64)]]).reshape(4, 15)
 
 
 def RealToOnehot(cards):
-    RealCard2EnvCard = {'3': 0, '4': 1, '5': 2, '6': 3, '7': 4,
-                        '8': 5, '9': 6, 'T': 7, 'J': 8, 'Q': 9,
-                        'K': 10, 'A': 11, '2': 12, 'X': 13, 'D': 14}
-    cards = [RealCard2EnvCard[c] for c in cards]
-    Onehot = torch.zeros((4,15))
-    for i in range(0, 15):
-        Onehot[:cards.count(i),i] = 1
-    return Onehot
+    return IdxToOnehotBatch([[Real2IdxMap[c] for c in cards]]).reshape(4, 15)
 
 
 class Net(nn.Module):
@@ -55,42 +67,75 @@ class Net(nn.Module):
 
 UseGPU = False
 device = torch.device('cuda:0')
-net_bid = Net()
-net_bid.eval()
-net_farmer = Net()
-net_farmer.eval()
-if UseGPU:
-    net_bid = net_bid.to(device)
-    net_farmer = net_farmer.to(device)
-if os.path.exists("./bid_weights.pkl"):
-    if torch.cuda.is_available():
-        net_bid.load_state_dict(torch.load('./bid_weights.pkl'))
-    else:
-        net_bid.load_state_dict(torch.load('./bid_weights.pkl', map_location=torch.device("cpu")))
-if os.path.exists("./farmer_weights.pkl"):
-    if torch.cuda.is_available():
-        net_farmer.load_state_dict(torch.load('./farmer_weights.pkl'))
-    else:
-        net_farmer.load_state_dict(torch.load('./farmer_weights.pkl', map_location=torch.device("cpu")))
+# Built and loaded from the current directory on first use, see
+# load_models
+net_bid = None
+net_farmer = None
 
 
-def predict(cards):
-    x = RealToOnehot(cards)
+def _load_net(path):
+    net = Net()
+    if os.path.exists(path):
+        net.load_state_dict(torch.load(path, map_location=device if UseGPU else torch.device("cpu")))
+    if UseGPU:
+        net = net.to(device)
+    return net.eval()
+
+
+def load_models():
+    """
+    The bid and farmer nets, loaded from ./bid_weights.pkl and
+    ./farmer_weights.pkl the first time they are needed.
+    """
+    global net_bid, net_farmer
+    if net_bid is None:
+        bid = _load_net('./bid_weights.pkl')
+        farmer = _load_net('./farmer_weights.pkl')
+        net_bid, net_farmer = bid, farmer
+    return net_bid, net_farmer
+
+
+def predict_batch(hands, output='both'):
+    """
+    Scores of any number of hands with a single forward per net.
+    A hand is a string of real cards ('3'-'9', 'TJQKA2XD') or a list
+    of env cards, and hands can have different numbers of cards.
+    `output` is 'bid' or 'farmer' to run only that net; by default
+    the (bid, farmer) pair is returned. Scores are numpy arrays of
+    shape (N,).
+    """
+    if len(hands) > 0 and isinstance(hands[0], str):
+        idx = [[Real2IdxMap[c] for c in hand] for hand in hands]
+    else:
+        idx = [Env2IdxArray[np.asarray(hand, dtype=np.int64)] for hand in hands]
+    x = IdxToOnehotBatch(idx)
     if UseGPU:
         x = x.to(device)
-    x = torch.flatten(x)
-    x = x.unsqueeze(0)
-    score_bid = net_bid(x)
-    score_farmer = net_farmer(x)
+    net_bid, net_farmer = load_models()
+    scores = []
+    with torch.no_grad():
+        for name, net in (('bid', net_bid), ('farmer', net_farmer)):
+            if output in ('both', name):
+                scores.append(net(x).cpu().numpy().reshape(-1))
+    return tuple(scores) if output == 'both' else scores[0]
+
+
+def predict(cards):
+    score_bid, score_farmer = predict_batch([cards])
     return score_bid[0].item(), score_farmer[0].item()
 
 
 def predict_env(cards):
-    x = EnvToOnehot(cards)
-    if UseGPU:
-        x = x.to(device)
-    x = torch.flatten(x)
-    x = x.unsqueeze(0)
-    score_bid = net_bid(x)
-    score_farmer = net_farmer(x)
-    return score_bid[0].item(), score_farmer[0].item()
\ No newline at end of file
+    score_bid, score_farmer = predict_batch([list(cards)])
+    return score_bid[0].item(), score_farmer[0].item()
+
+
+def predict_env_batch(hands):
+    """
+    Bid scores of hands of env cards, see `predict_batch`. `hands`
+    has shape (..., k), e.g. (3, 17) for the three hands of a deal
+    or (N, 3, 17) for N deals, and the scores have shape (...).
+    """
+    hands = np.asarray(hands, dtype=np.int64)
+    scores = predict_batch(hands.reshape(-1, hands.shape[-1]), output='bid')
+    return scores.reshape(hands.shape[:-1])
@@ -0,0 +1,158 @@
+import argparse
+import importlib
+import json
+import os
+
+
+def run_obs(args):
+    from douzero.env import benchmark
+
+    if args.save:
+        print("generating golden observations:", args.golden)
+        golden = benchmark.save_golden(args.golden, args.num_games, args.seed)
+    elif not os.path.exists(args.golden):
+        print("golden file %s not found, create it with --save" % args.golden)
+        return 1
+    else:
+        try:
+            golden = benchmark.load_golden(args.golden)
+        except ValueError as e:
+            print(e)
+            return 1
+
+    names = args.encoders or benchmark.ENCODERS
+    candidate = None
+    if args.candidate:
+        module_name, func_name = args.candidate.split(':')
+        candidate = getattr(importlib.import_module(module_name), func_name)
+        names = [args.candidate_for]
+
+    ok = True
+    for name in names:
+        checked, failures = benchmark.check_encoder(golden, name, candidate)
+        timings = benchmark.benchmark_encoder(golden, name, candidate, args.repeat)
+        print(benchmark.format_report(name, checked, failures, timings))
+        ok = ok and not failures
+        if candidate is None and name in benchmark.BATCH_ENCODERS:
+            checked, failures, us = benchmark.check_batch_encoder(golden, name)
+            print(benchmark.format_report(benchmark.BATCH_ENCODERS[name], checked, failures, {}))
+            print('    batch of %-11d %9.1f us/deal' % (checked, us))
+            ok = ok and not failures
+    checked_version = benchmark.features.CHECKED_ENV_VERSION
+    if candidate is None and golden.get('env_version') != checked_version:
+        # The client encoders are only used with the env.py they
+        # were checked against
+        print("golden file is from env.py %s, the client encoders are used with env.py %s%s" % (
+            golden.get('env_version'), checked_version,
+            '; all match, set features.CHECKED_ENV_VERSION to enable them' if ok else ''))
+    return 0 if ok else 1
+
+
+def _parse_ints(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def run_models(args):
+    from douzero.dmc import benchmark
+    from douzero.dmc.dmc import program_version
+
+    weights = dict(item.split('=', 1) for item in args.weights)
+    results = benchmark.benchmark_models(args.models, args.backends,
+                                         _parse_ints(args.batch_sizes) if args.batch_sizes else None,
+                                         _parse_ints(args.threads) if args.threads else None,
+                                         weights, args.seconds)
+    report = {'environment': benchmark.environment_info(program_version),
+              'weights': weights, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to', args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = benchmark.compare_results(baseline['results'], results, args.threshold)
+        for result, baseline_ms in regressions:
+            print('REGRESSION %s (was %.3f ms)' % (benchmark.format_result(result), baseline_ms))
+        print('%d regressions against %s' % (len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
+
+
+def run_upload(args):
+    from douzero.dmc import benchmark
+
+    batches = benchmark.record_upload_batches(args.num_batches, args.unroll_length, args.batch_size)
+    results = benchmark.benchmark_upload(batches, args.repeat)
+    for result in results:
+        print(benchmark.format_upload_result(result))
+    pickled, binary = results
+    print('binary vs pickle: encode %.1fx faster, %.1fx smaller gzipped' % (
+        pickled['encode_gzip_ms'] / binary['encode_gzip_ms'], pickled['gzip_bytes'] / binary['gzip_bytes']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+    return 0 if all(result['same_as_pickle'] for result in results) else 1
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='DouZero: benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    obs = subparsers.add_parser('obs', help='Check and time the observation encoders')
+    obs.add_argument('--golden', default='obs_golden.pkl', type=str,
+                     help='Golden observations file')
+    obs.add_argument('--save', action='store_true',
+                     help='Regenerate the golden file from the reference encoders of env.py')
+    obs.add_argument('--num_games', default=50, type=int,
+                     help='Number of seeded games used to build the golden file')
+    obs.add_argument('--seed', default=0, type=int)
+    obs.add_argument('--encoders', nargs='*', default=None,
+                     help='Encoders to check (default: all)')
+    obs.add_argument('--candidate', default=None, type=str,
+                     help='Replacement encoder to check, as module:function')
+    obs.add_argument('--candidate_for', default='_get_obs_general', type=str,
+                     help='Name of the encoder the candidate replaces')
+    obs.add_argument('--repeat', default=20, type=int,
+                     help='Timed calls per observation')
+    obs.set_defaults(func=run_obs)
+
+    models = subparsers.add_parser('models', help='Time the models per batch size, thread count and backend')
+    models.add_argument('--models', nargs='*', default=None,
+                        help='Models to time: general, mingpai, bid_net (the deal-scoring net of BidModel.py), '
+                             'bid, lstm_landlord, lstm_farmer (default: all)')
+    models.add_argument('--backends', nargs='*', default=None,
+                        help='Backends to time: eager, torchscript, int8, onnx (default: all available)')
+    models.add_argument('--batch_sizes', default='', type=str,
+                        help='Comma separated legal-action batch sizes (default: powers of two from 1 to 512)')
+    models.add_argument('--threads', default='', type=str,
+                        help='Comma separated torch thread counts (default: powers of two up to the core count)')
+    models.add_argument('--weights', nargs='*', default=[],
+                        help='Real weights as model=path.ckpt, e.g. general=models/landlord.ckpt or '
+                             'bid_net=bid_weights.pkl (default: random)')
+    models.add_argument('--seconds', default=0.2, type=float,
+                        help='Minimum time each combination is measured for')
+    models.add_argument('--output', default='model_benchmark.json', type=str,
+                        help='Where the results are written as JSON')
+    models.add_argument('--baseline', default=None, type=str,
+                        help='Earlier results to compare with; exits with 1 on regressions')
+    models.add_argument('--threshold', default=0.1, type=float,
+                        help='Relative slowdown counted as a regression')
+    models.set_defaults(func=run_models)
+
+    upload = subparsers.add_parser('upload', help='Time and size the batch upload formats')
+    upload.add_argument('--num_batches', default=2, type=int,
+                        help='Batches per position in one upload')
+    upload.add_argument('--unroll_length', default=100, type=int)
+    upload.add_argument('--batch_size', default=16, type=int)
+    upload.add_argument('--repeat', default=3, type=int,
+                        help='Timed encodes per format')
+    upload.add_argument('--output', default=None, type=str,
+                        help='Also write the results as JSON')
+    upload.set_defaults(func=run_upload)
+    return parser
+
+
+if __name__ == '__main__':
+    flags = get_parser().parse_args()
+    exit(flags.func(flags))
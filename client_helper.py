@@ -1,4 +1,5 @@
 import sys
+import numpy as np
 import torch
 import bit_helper
 import pickle
@@ -7,6 +8,7 @@ from requests import ReadTimeout
 import time
 import json
 import hashlib
+import struct
 import traceback
 import gzip
 debug = False
@@ -50,6 +52,115 @@ def unpack_batch(data):
     }
     return batch
 
+# Binary upload format: WIRE_MAGIC, the length of a JSON header
+# (uint32, little endian), the header, then the raw bytes of every
+# field of every batch in header order. The header holds the upload
+# info and, for each field, its name, dtype, shape, bit width
+# (0 for unpacked) and the offset added before packing.
+WIRE_MAGIC = b'DZW1'
+WIRE_CONTENT_TYPE = 'application/x-douzero-batches'
+# Field -> (numpy dtype on the wire, bit width, offset). Dtypes are
+# little endian whatever the byte order of the client.
+WIRE_FIELDS = [
+    ("done", "<i1", 1, 0),
+    ("episode_return", "<f4", 0, 0),
+    ("target", "<f4", 0, 0),
+    ("obs_x_batch", "<i1", 1, 0),
+    ("obs_z", "<i1", 2, 1),
+    ("obs_type", "<i1", 0, 0),
+]
+WIRE_MASKS = {1: 0b00000001, 2: 0b00000011}
+# Wire dtype -> torch dtype the field is converted to before packing
+WIRE_TORCH_DTYPES = {"<i1": torch.int8, "<f4": torch.float32}
+# Field -> dtype after decoding, as returned by unpack_batch
+WIRE_DECODED_DTYPES = {"done": torch.bool}
+
+
+def _pack_field(tensor, dtype, bits, offset):
+    tensor = tensor.to(WIRE_TORCH_DTYPES[dtype])
+    if offset:
+        tensor = tensor + offset
+    if bits:
+        tensor = bit_helper.packbits(tensor, mask=WIRE_MASKS[bits])
+    # Not copied when the client is little endian
+    return tensor.contiguous().numpy().astype(dtype, copy=False)
+
+
+def encode_batches(batches, model_version, program_version, username):
+    """
+    The binary upload of `batches` (dicts of position and batch).
+    Field bytes are taken from the tensor buffers without going
+    through Python lists.
+    """
+    header = {
+        "model_version": model_version,
+        "program_version": program_version,
+        "username": username,
+        "batches": [],
+    }
+    payloads = []
+    for batch in batches:
+        fields = []
+        for name, dtype, bits, offset in WIRE_FIELDS:
+            tensor = batch["batch"][name]
+            array = _pack_field(tensor, dtype, bits, offset)
+            fields.append({"name": name, "dtype": dtype, "shape": list(tensor.shape),
+                           "bits": bits, "offset": offset, "nbytes": array.nbytes})
+            payloads.append(memoryview(array).cast('B'))
+        header["batches"].append({"position": batch["position"], "fields": fields})
+    meta = json.dumps(header).encode('utf-8')
+    return b''.join([WIRE_MAGIC, struct.pack('<I', len(meta)), meta] + payloads)
+
+
+def decode_batches(data):
+    """
+    The upload info of a binary upload, with every batch unpacked
+    as by unpack_batch.
+    """
+    if data[:len(WIRE_MAGIC)] != WIRE_MAGIC:
+        raise ValueError("Not a binary batch upload")
+    meta_len, = struct.unpack_from('<I', data, len(WIRE_MAGIC))
+    start = len(WIRE_MAGIC) + 4
+    info = json.loads(bytes(data[start:start + meta_len]).decode('utf-8'))
+    pos = start + meta_len
+    for batch in info["batches"]:
+        fields = {}
+        for field in batch.pop("fields"):
+            array = np.frombuffer(data, dtype=field["dtype"], offset=pos,
+                                  count=field["nbytes"] // np.dtype(field["dtype"]).itemsize)
+            pos += field["nbytes"]
+            tensor = torch.from_numpy(array.astype(array.dtype.newbyteorder('=')))
+            if field["bits"]:
+                mask = WIRE_MASKS[field["bits"]]
+                packed_shape, _, _ = bit_helper.packshape(field["shape"], -1, mask, tensor.dtype)
+                tensor = bit_helper.unpackbits(tensor.reshape(packed_shape), field["shape"], mask=mask)
+            else:
+                tensor = tensor.reshape(field["shape"])
+            if field["offset"]:
+                tensor = tensor - field["offset"]
+            fields[field["name"]] = tensor.to(WIRE_DECODED_DTYPES.get(field["name"], tensor.dtype))
+        batch["batch"] = fields
+    return info
+
+
+def encode_pickle(batches, model_version, program_version, username):
+    """
+    The pickled upload of `batches`, before compression.
+    """
+    data = []
+    for batch in batches:
+        data.append({
+            "position": batch["position"],
+            "batch": pack_batch(batch["batch"]),
+        })
+    info = {
+        "batches": data,
+        "model_version": model_version,
+        "program_version": program_version,
+        "username": username
+    }
+    return pickle.dumps(info)
+
 data_total = 0
 start_time = time.time()
 
@@ -68,28 +179,20 @@ def handle_batch(position, batch, model_version, program_version):
         return model_version, ""
 
 def handle_batches(batches, model_version, program_version, flags):
-    data = []
-
-    for batch in batches:
-        data.append({
-            "position": batch["position"],
-            "batch": pack_batch(batch["batch"]),
-        })
-    info = {
-        "batches": data,
-        "model_version": model_version,
-        "program_version": program_version,
-        "username": flags.username
-    }
-    # print(batches)
-    data = pickle.dumps(info)
+    if flags.upload_format == "binary":
+        data = encode_batches(batches, model_version, program_version, flags.username)
+        content_type = WIRE_CONTENT_TYPE
+    else:
+        data = encode_pickle(batches, model_version, program_version, flags.username)
+        content_type = 'application/octet-stream'
     data = gzip.compress(data)
+    headers = {'Content-Type': content_type, 'Content-Encoding': 'gzip','Accept-encoding': 'gzip'}
     tryCount = 2
     rep = None
     print("准备发送Batch")
     try:
         try:
-            rep = requests.post(HOST + "/upload_batch", data, headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip','Accept-encoding': 'gzip'}, timeout=120)
+            rep = requests.post(HOST + "/upload_batch", data, headers=headers, timeout=120)
         except TimeoutError as e:
             rep = None
             print("传输超时")
@@ -100,7 +203,7 @@ def handle_batches(batches, model_version, program_version, flags):
             tryCount -= 1
             print("传输失败，重试中")
             try:
-                rep = requests.post(HOST + "/upload_batch", data, headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip','Accept-encoding': 'gzip'}, timeout=120)
+                rep = requests.post(HOST + "/upload_batch", data, headers=headers, timeout=120)
             except TimeoutError:
                 rep = None
                 print("传输超时")
@@ -1,2 +1,22 @@
-from .dmc import train
-from .arguments import parser
+"""
+The training entry points are imported on first use, so that actors
+and evaluation workers importing `douzero.dmc.models` or
+`douzero.dmc.utils` do not load the training client.
+"""
+import importlib
+
+_EXPORTS = {
+    'train': '.dmc',
+    'parser': '.arguments',
+    'autotune': '.autotune',
+    'load_autotune': '.autotune',
+    'distill': '.distill',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
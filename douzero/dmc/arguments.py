@@ -13,6 +13,9 @@ parser.add_argument('--username', default='default', type=str,
                     help='Your username')
 parser.add_argument('--password', default='0', type=str,
                     help='Your password')
+parser.add_argument('--upload_format', default='pickle', type=str, choices=['pickle', 'binary'],
+                    help='How batches are uploaded: pickled lists (default) or the binary format of '
+                         'client_helper.encode_batches (the server must support it)')
 
 # Training settings
 parser.add_argument('--actor_device_cpu', default=1, type=int,
@@ -23,15 +26,85 @@ parser.add_argument('--num_actor_devices', default=1, type=int,
                     help='The number of devices used for simulation')
 parser.add_argument('--num_actors', default=3, type=int,
                     help='The number of actors for each simulation device')
+parser.add_argument('--actor_threads', default=0, type=int,
+                    help='The number of torch threads of each actor (0 to keep the torch default)')
+parser.add_argument('--actor_affinity', default=0, type=int,
+                    help='Pin each actor to its own actor_threads CPU cores (Linux only)')
+parser.add_argument('--start_method', default='spawn', type=str, choices=['spawn', 'forkserver'],
+                    help='How actors are started; forkserver imports torch and the bid model once and forks the actors from it (not on Windows)')
+parser.add_argument('--actor_backend', default='eager', type=str, choices=['eager', 'torchscript', 'int8', 'onnx'],
+                    help='How actors run the models: eager PyTorch, frozen TorchScript exported with BatchNorm folded, '
+                         'the same with int8 linear layers, or ONNX Runtime on CPU (needs onnxruntime)')
+parser.add_argument('--actor_student', action='store_true',
+                    help='Actors choose moves with the distilled student models (see --distill); '
+                         'full observations are still recorded and uploaded')
+parser.add_argument('--quantize_min_agreement', default=0.98, type=float,
+                    help='The fraction of held-out decisions an int8 model must agree on with the fp32 model to be used')
+parser.add_argument('--export_tolerance', default=1e-4, type=float,
+                    help='The largest difference from the eager model allowed for an exported model')
+parser.add_argument('--factorize_first_layer', action='store_true',
+                    help='Convolve the state rows shared by the legal actions of a decision once instead of once per action')
+parser.add_argument('--num_envs', default=1, type=int,
+                    help='The number of games each actor plays at once, scored with one batched forward')
+parser.add_argument('--deal_pool_size', default=256, type=int,
+                    help='The number of pre-scored deals each actor keeps ready (0 to deal in reset)')
+parser.add_argument('--deal_batch_size', default=64, type=int,
+                    help='The number of deals generated and scored at once by the deal pool')
+parser.add_argument('--num_inference_workers', default=0, type=int,
+                    help='The number of inference server processes scoring the moves of the CPU actors (0 to score in the actors)')
+parser.add_argument('--inference_batch_size', default=1024, type=int,
+                    help='The number of legal-action rows an inference worker collects before running a forward')
+parser.add_argument('--inference_max_wait', default=2.0, type=float,
+                    help='The time (in milliseconds) an inference worker waits for more requests to fill a batch')
+parser.add_argument('--inference_threads', default=4, type=int,
+                    help='The number of torch threads of each inference worker')
+parser.add_argument('--inference_max_rows', default=2048, type=int,
+                    help='The number of legal-action rows of the shared slot of each actor; larger requests are scored in the actor')
+parser.add_argument('--inference_timeout', default=5.0, type=float,
+                    help='Seconds an actor waits for the inference workers before scoring a request with its own model')
+parser.add_argument('--actor_restart_backoff', default=1.0, type=float,
+                    help='Seconds before a crashed actor is restarted, doubled for every crash in a row')
+parser.add_argument('--actor_restart_max_backoff', default=60.0, type=float,
+                    help='The longest wait before a crashed actor is restarted')
 parser.add_argument('--training_device', default='cpu', type=str,
                     help='The index of the GPU used for training models')
 parser.add_argument('--load_model', action='store_true', default=True,
                     help='Load an existing model')
 parser.add_argument('--disable_checkpoint', action='store_true',
                     help='Disable saving checkpoint')
+parser.add_argument('--disable_stage_timing', action='store_true',
+                    help='Disable timing the stages of the actor loop')
 parser.add_argument('--savedir', default='douzero_checkpoints',
                     help='Root dir where experiment data will be saved')
 
+# Autotune settings
+parser.add_argument('--autotune', action='store_true',
+                    help='Measure the fps of several actor configurations and save the best one')
+parser.add_argument('--autotune_file', default='autotune.json', type=str,
+                    help='Where the best configuration is saved; it is applied to later runs')
+parser.add_argument('--autotune_actors', default='', type=str,
+                    help='Comma separated actor counts to try (default: powers of two up to the core count)')
+parser.add_argument('--autotune_threads', default='', type=str,
+                    help='Comma separated per-actor thread counts to try (default: 1,2,4)')
+parser.add_argument('--autotune_warmup', default=20, type=int,
+                    help='Seconds each trial runs before it is measured')
+parser.add_argument('--autotune_seconds', default=40, type=int,
+                    help='Seconds each trial is measured for')
+
+# Distillation settings
+parser.add_argument('--distill', action='store_true',
+                    help='Train compact student models on the values of the current models and save them to ./models')
+parser.add_argument('--distill_file', default='distill_data.pt', type=str,
+                    help='Where the recorded self-play decisions are kept; recorded if missing')
+parser.add_argument('--distill_games', default=200, type=int,
+                    help='The number of self-play games recorded for training (a quarter more are held out)')
+parser.add_argument('--distill_epochs', default=10, type=int,
+                    help='Passes over the recorded decisions')
+parser.add_argument('--student_channels', default=32, type=int,
+                    help='Channels of the first residual block of a student (doubled in the second)')
+parser.add_argument('--student_hidden', default=256, type=int,
+                    help='Width of the first hidden layer of a student')
+
 # Hyperparameters
 parser.add_argument('--total_frames', default=100000000000, type=int,
                     help='Total environment frames to train for')
@@ -44,7 +117,7 @@ parser.add_argument('--unroll_length', default=100, type=int,
 parser.add_argument('--num_buffers', default=50, type=int,
                     help='Number of shared-memory buffers')
 parser.add_argument('--num_threads', default=4, type=int,
-                    help='Number learner threads')
+                    help='Unused, batches are collected by one thread per position')
 parser.add_argument('--max_grad_norm', default=40., type=float,
                     help='Max norm of gradients')
 
@@ -0,0 +1,162 @@
+"""
+Throughput autotuning of the actors. Short self-play trials are
+run for combinations of the number of actors, the torch threads
+of every actor and CPU pinning; the frames per second of every
+trial are measured and the best combination is saved so that
+later runs of train.py start from it.
+"""
+import copy
+import json
+import os
+import queue
+import threading
+import time
+
+from .models import MingpaiModels, load_weights
+from .utils import act, create_buffers, log, get_context
+
+TUNED_KEYS = ['num_actors', 'actor_threads', 'actor_affinity']
+POSITIONS = ['landlord', 'landlord_up', 'landlord_down']
+
+
+def _parse_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def candidate_configs(flags):
+    """
+    The (num_actors, actor_threads, actor_affinity) combinations to
+    try. Unless the actor counts are given, combinations using more
+    threads than cores are skipped.
+    """
+    num_cpus = os.cpu_count() or 1
+    if flags.autotune_actors:
+        actor_counts = _parse_list(flags.autotune_actors)
+    else:
+        actor_counts = sorted(set([n for n in (1, 2, 4, 8, 16, 32, 64) if n <= num_cpus] + [num_cpus]))
+    if flags.autotune_threads:
+        thread_counts = _parse_list(flags.autotune_threads)
+    else:
+        thread_counts = [1, 2, 4]
+    affinities = [0, 1] if hasattr(os, 'sched_setaffinity') else [0]
+    configs = []
+    for num_actors in actor_counts:
+        for actor_threads in thread_counts:
+            if not flags.autotune_actors and num_actors * actor_threads > num_cpus:
+                continue
+            for actor_affinity in affinities:
+                configs.append((num_actors, actor_threads, actor_affinity))
+    return configs
+
+
+def _load_models():
+    model = MingpaiModels(device="cpu")
+    for position in POSITIONS:
+        path = "./models/" + position + ".ckpt"
+        if os.path.exists(path):
+            model.load_state_dict(position, load_weights(path))
+    model.bump_version()
+    model.share_memory()
+    model.eval()
+    return model
+
+
+def run_trial(flags, model, num_actors, actor_threads, actor_affinity):
+    """
+    Play for `flags.autotune_warmup` + `flags.autotune_seconds`
+    seconds with the given configuration and return the frames
+    per second of the measured part.
+    """
+    flags = copy.copy(flags)
+    flags.num_actors = num_actors
+    flags.actor_threads = actor_threads
+    flags.actor_affinity = actor_affinity
+
+    ctx = get_context(flags)
+    buffers = create_buffers(flags, ['cpu'])['cpu']
+    free_queue = {p: ctx.Queue() for p in POSITIONS}
+    full_queue = {p: ctx.Queue() for p in POSITIONS}
+    for p in POSITIONS:
+        for m in range(flags.num_buffers):
+            free_queue[p].put(m)
+
+    frames = [0]
+    stop = threading.Event()
+
+    def consume(position):
+        # Hand the unrolls straight back, only counting them
+        while not stop.is_set():
+            try:
+                index = full_queue[position].get(timeout=0.1)
+            except queue.Empty:
+                continue
+            frames[0] += flags.unroll_length
+            free_queue[position].put(index)
+
+    threads = [threading.Thread(target=consume, args=(p,), daemon=True) for p in POSITIONS]
+    for thread in threads:
+        thread.start()
+    actors = []
+    for i in range(num_actors):
+        actor = ctx.Process(target=act,
+                            args=(i, 'cpu', free_queue, full_queue, model, buffers, flags))
+        actor.start()
+        actors.append(actor)
+    try:
+        time.sleep(flags.autotune_warmup)
+        start_frames, start_time = frames[0], time.time()
+        time.sleep(flags.autotune_seconds)
+        fps = (frames[0] - start_frames) / (time.time() - start_time)
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.terminate()
+        for actor in actors:
+            actor.join()
+        for thread in threads:
+            thread.join()
+    return fps
+
+
+def autotune(flags):
+    """
+    Run all the trials and save the best configuration to
+    `flags.autotune_file`.
+    """
+    model = _load_models()
+    configs = candidate_configs(flags)
+    print("自动调优: 共 %d 组配置，每组约 %d 秒" % (len(configs), flags.autotune_warmup + flags.autotune_seconds))
+    trials = []
+    for num_actors, actor_threads, actor_affinity in configs:
+        fps = run_trial(flags, model, num_actors, actor_threads, actor_affinity)
+        log.info('num_actors=%d actor_threads=%d actor_affinity=%d: %.1f fps',
+                 num_actors, actor_threads, actor_affinity, fps)
+        trials.append(dict(num_actors=num_actors, actor_threads=actor_threads,
+                           actor_affinity=actor_affinity, fps=fps))
+    best = max(trials, key=lambda trial: trial['fps'])
+    result = {key: best[key] for key in TUNED_KEYS}
+    result['fps'] = best['fps']
+    result['trials'] = trials
+    with open(flags.autotune_file, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("自动调优完成: num_actors=%d actor_threads=%d actor_affinity=%d (%.1f fps)，已保存到 %s" % (
+        best['num_actors'], best['actor_threads'], best['actor_affinity'], best['fps'], flags.autotune_file))
+    return result
+
+
+def load_autotune(flags, parser):
+    """
+    Apply a saved autotune result to the flags that were left at
+    their default values.
+    """
+    if not os.path.exists(flags.autotune_file):
+        return
+    with open(flags.autotune_file, 'r') as f:
+        result = json.load(f)
+    applied = []
+    for key in TUNED_KEYS:
+        if key in result and getattr(flags, key) == parser.get_default(key):
+            setattr(flags, key, result[key])
+            applied.append('%s=%s' % (key, result[key]))
+    if applied:
+        print("使用自动调优配置:", ' '.join(applied))
@@ -0,0 +1,312 @@
+"""
+Latency and throughput harness for the models. Every model is
+timed on random inputs for a range of legal-action batch sizes and
+torch thread counts, with each backend it can be exported to, and
+the results are kept as plain dicts so that runs of different
+client versions can be saved as JSON and compared. The upload
+formats of client_helper are timed on batches of self-play frames.
+"""
+import copy
+import gzip
+import os
+import pickle
+import platform
+import random
+import time
+import warnings
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+import numpy as np
+
+import BidModel
+from douzero.env.env import Env, env_version
+from .models import GeneralModel, MingpaiModel, MODEL_REGISTRY, build_model, load_model, load_weights
+from .export import export_torchscript, export_onnx, OnnxRunner, _onnx_available
+
+# The deal-scoring Net of the top-level BidModel.py, run by
+# ClientEnv.reset and the DealPool on every deal. 'bid' is the
+# bidding model of the registry, which actors do not run.
+BID_NET = 'bid_net'
+# Models that are timed: registered architectures and BID_NET
+MODELS = ['general', 'mingpai', BID_NET, 'bid', 'lstm_landlord', 'lstm_farmer']
+BACKENDS = ['eager', 'torchscript', 'int8', 'onnx']
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+# Folded exports only exist for the ResNet models
+FOLDABLE = (GeneralModel, MingpaiModel)
+
+
+def _cards(*shape):
+    return torch.randint(0, 2, shape).float()
+
+
+def make_inputs(name, batch_size):
+    """
+    Random (z, x) of `batch_size` legal actions for the registered
+    architecture `name`, or of `batch_size` hands for BID_NET.
+    """
+    if name == BID_NET:
+        return torch.zeros(1), _cards(batch_size, 60)
+    spec = MODEL_REGISTRY[name]
+    z_rows = 1 if spec['z_shared'] else batch_size
+    z = _cards(z_rows, *spec['z_shape']) if spec['z_shape'] else torch.zeros(1)
+    x = _cards(batch_size, *spec['x_shape']) if spec['x_shape'] else torch.zeros(1)
+    return z, x
+
+
+def default_thread_counts():
+    num_cpus = os.cpu_count() or 1
+    return sorted(set([n for n in (1, 2, 4, 8, 16) if n <= num_cpus] + [num_cpus]))
+
+
+def make_model(name, weights=None):
+    """
+    An eval-mode model `name` with random weights, or the weights
+    saved at `weights`.
+    """
+    if name == BID_NET:
+        net = BidModel.Net()
+        if weights is not None:
+            net.load_state_dict(load_weights(weights))
+        return _BidNet(net).eval()
+    if weights is not None:
+        return load_model(weights, name)
+    return build_model(name).eval()
+
+
+class _BidNet(nn.Module):
+    def __init__(self, net):
+        """
+        The model interface around a BidModel.Net, which scores the
+        one-hot hands given as `x`.
+        """
+        super().__init__()
+        self.net = net
+
+    def forward(self, z, x, return_value=False):
+        return dict(values=self.net(x))
+
+
+class _Values(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, z, x):
+        return self.model.forward(z, x, True)['values']
+
+
+def _trace(module, z, x):
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return torch.jit.freeze(torch.jit.trace(module.eval(), (z, x)))
+
+
+def build_backend(name, model, backend, directory='.'):
+    """
+    The forward function of `model` for `backend`, or None if the
+    backend is not available for it. Exports are traced with a
+    batch of 8 and run with any batch size.
+    """
+    z, x = make_inputs(name, 8)
+    if backend == 'eager':
+        values = _Values(model)
+        return lambda z, x: values(z, x)
+    if backend == 'onnx':
+        if not isinstance(model, FOLDABLE) or not _onnx_available():
+            return None
+        path = os.path.join(directory, 'benchmark_%s.onnx' % name)
+        export_onnx(model, z, x, path)
+        runner = OnnxRunner(path, torch.get_num_threads())
+        os.remove(path)
+        return runner
+    quantize = backend == 'int8'
+    if isinstance(model, FOLDABLE):
+        return export_torchscript(model, z, x, quantize=quantize)
+    model = copy.deepcopy(model)
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return _trace(_Values(model), z, x)
+
+
+def time_forward(forward, z, x, min_seconds=0.2, min_repeat=5):
+    """
+    Median and 90th percentile milliseconds per call of
+    `forward(z, x)`, run for at least `min_seconds`.
+    """
+    times = []
+    with torch.no_grad():
+        for _ in range(3):
+            forward(z, x)
+        start = time.perf_counter()
+        while len(times) < min_repeat or time.perf_counter() - start < min_seconds:
+            st = time.perf_counter()
+            forward(z, x)
+            times.append((time.perf_counter() - st) * 1e3)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.9)]
+
+
+def benchmark_models(names=None, backends=None, batch_sizes=None, thread_counts=None,
+                     weights=None, min_seconds=0.2, log=print):
+    """
+    Time every combination of model, backend, thread count and
+    batch size. `weights` maps model names to checkpoint paths.
+    Returns one dict per combination with the median and 90th
+    percentile latency in milliseconds and the legal-action rows
+    scored per second.
+    """
+    names = names or list(MODELS)
+    backends = backends or BACKENDS
+    batch_sizes = batch_sizes or BATCH_SIZES
+    thread_counts = thread_counts or default_thread_counts()
+    weights = weights or {}
+    torch.manual_seed(0)
+    results = []
+    for num_threads in thread_counts:
+        torch.set_num_threads(num_threads)
+        for name in names:
+            model = make_model(name, weights.get(name))
+            for backend in backends:
+                forward = build_backend(name, model, backend)
+                if forward is None:
+                    log('%s: %s not available, skipped' % (name, backend))
+                    continue
+                for batch_size in batch_sizes:
+                    z, x = make_inputs(name, batch_size)
+                    median_ms, p90_ms = time_forward(forward, z, x, min_seconds)
+                    result = OrderedDict(model=name, backend=backend, threads=num_threads,
+                                         batch_size=batch_size, median_ms=median_ms, p90_ms=p90_ms,
+                                         rows_per_s=batch_size / median_ms * 1e3)
+                    log(format_result(result))
+                    results.append(result)
+    return results
+
+
+def environment_info(client_version=None):
+    """
+    What a run depends on, saved alongside its results.
+    """
+    return OrderedDict(client_version=client_version, env_version=env_version,
+                       torch=torch.__version__, python=platform.python_version(),
+                       machine=platform.machine(), processor=platform.processor(),
+                       cpu_count=os.cpu_count())
+
+
+def format_result(result):
+    return '%-14s %-12s threads %-3d batch %-4d %9.3f ms (p90 %9.3f) %12.0f rows/s' % (
+        result['model'], result['backend'], result['threads'], result['batch_size'],
+        result['median_ms'], result['p90_ms'], result['rows_per_s'])
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """
+    The combinations of `results` whose median latency is more than
+    `threshold` (relative) above the same combination in
+    `baseline`, as (result, baseline_ms) pairs.
+    """
+    def key(result):
+        return result['model'], result['backend'], result['threads'], result['batch_size']
+    baseline = {key(result): result['median_ms'] for result in baseline}
+    return [(result, baseline[key(result)]) for result in results
+            if key(result) in baseline and result['median_ms'] > baseline[key(result)] * (1 + threshold)]
+
+
+UPLOAD_FORMATS = ['pickle', 'binary']
+
+
+def record_upload_batches(num_batches, unroll_length, batch_size, seed=0):
+    """
+    `num_batches` upload batches per position, shaped as the learner
+    collects them, (T, B, ...), from games played with random moves.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    env = Env('adp')
+    frames = {position: [] for position in ['landlord', 'landlord_up', 'landlord_down']}
+    needed = num_batches * unroll_length * batch_size
+    obs = env.reset(None, 'cpu')
+    game = []
+    while min(len(f) for f in frames.values()) < needed:
+        k = random.randrange(len(obs['legal_actions']))
+        game.append((obs['position'], dict(obs_z=torch.from_numpy(obs['z_batch'][k]).to(torch.int8),
+                                           obs_x_batch=torch.from_numpy(obs['x_no_action']).to(torch.int8),
+                                           obs_type=0, done=False)))
+        obs, reward, done, _ = env.step(obs['legal_actions'][k])
+        if done:
+            for position in frames:
+                steps = [frame for p, frame in game if p == position]
+                steps[-1]['done'] = True
+                for frame in steps:
+                    returns = reward['play'][position]
+                    frame['target'] = float(returns if position == 'landlord' else -returns)
+                    frame['episode_return'] = frame['target'] if frame['done'] else 0.0
+                frames[position].extend(steps)
+            game = []
+            obs = env.reset(None, 'cpu')
+    batches = []
+    for position, position_frames in frames.items():
+        for n in range(num_batches):
+            chunk = position_frames[n * needed // num_batches:(n + 1) * needed // num_batches]
+            batch = {}
+            for key in ['obs_z', 'obs_x_batch']:
+                batch[key] = torch.stack([frame[key] for frame in chunk])
+            batch['done'] = torch.tensor([frame['done'] for frame in chunk])
+            batch['episode_return'] = torch.tensor([frame['episode_return'] for frame in chunk])
+            batch['target'] = torch.tensor([frame['target'] for frame in chunk])
+            batch['obs_type'] = torch.tensor([frame['obs_type'] for frame in chunk])
+            batch = {key: value.reshape((unroll_length, batch_size) + value.shape[1:])
+                     for key, value in batch.items()}
+            batches.append(dict(position=position, batch=batch))
+    return batches
+
+
+def _same_batches(expected, decoded):
+    for batch, other in zip(expected, decoded):
+        for key, value in batch['batch'].items():
+            if not torch.equal(value.to(other['batch'][key].dtype), other['batch'][key]):
+                return False
+    return True
+
+
+def benchmark_upload(batches, repeat=3):
+    """
+    Time encoding and decoding `batches` with every upload format.
+    Returns one dict per format with the milliseconds to encode
+    (before and with gzip) and decode, the payload bytes before and
+    after gzip, and whether decoding gives the same batches as the
+    pickle format (which keeps obs_x_batch to one bit per value).
+    """
+    # A top-level module of the client, like in dmc
+    import client_helper
+
+    results, reference = [], None
+    for name in UPLOAD_FORMATS:
+        encode = client_helper.encode_batches if name == 'binary' else client_helper.encode_pickle
+        st = time.perf_counter()
+        for _ in range(repeat):
+            data = encode(batches, 0, '', '')
+        encode_ms = (time.perf_counter() - st) / repeat * 1e3
+        st = time.perf_counter()
+        compressed = gzip.compress(data)
+        gzip_ms = (time.perf_counter() - st) * 1e3
+        st = time.perf_counter()
+        if name == 'binary':
+            decoded = client_helper.decode_batches(gzip.decompress(compressed))['batches']
+        else:
+            decoded = [dict(batch, batch=client_helper.unpack_batch(batch['batch']))
+                       for batch in pickle.loads(gzip.decompress(compressed))['batches']]
+        decode_ms = (time.perf_counter() - st) * 1e3
+        reference = reference or decoded
+        results.append(OrderedDict(format=name, encode_ms=encode_ms, encode_gzip_ms=encode_ms + gzip_ms,
+                                   decode_ms=decode_ms, bytes=len(data), gzip_bytes=len(compressed),
+                                   same_as_pickle=_same_batches(reference, decoded)))
+    return results
+
+
+def format_upload_result(result):
+    return '%-7s encode %8.1f ms (%8.1f ms with gzip) decode %8.1f ms %11d bytes (%10d gzipped) %s' % (
+        result['format'], result['encode_ms'], result['encode_gzip_ms'], result['decode_ms'],
+        result['bytes'], result['gzip_bytes'], 'OK' if result['same_as_pickle'] else 'MISMATCH')
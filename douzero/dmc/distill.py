@@ -0,0 +1,174 @@
+"""
+Distillation of the actor models into compact students. Decisions
+of local self-play games are recorded together with the values the
+current (teacher) models give every legal action, a StudentModel
+per position is trained to regress those values, and the students
+that actors can play with (--actor_student) are saved next to the
+teacher checkpoints. Recordings and students keep the hash of the
+teacher weights and are not used with other weights.
+"""
+import os
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from douzero.env.client_env import ClientEnv
+from .models import MingpaiModels, StudentModel, load_weights, state_dict_hash
+from .export import (POSITIONS, check_equivalence, benchmark_latency, _eager_values,
+                     student_path, save_student)
+
+
+def _load_teacher():
+    model = MingpaiModels(device="cpu")
+    for position in POSITIONS:
+        model.load_state_dict(position, load_weights("./models/" + position + ".ckpt"))
+    model.bump_version()
+    model.eval()
+    return model
+
+
+def _teacher_hashes(teacher):
+    return {position: state_dict_hash(teacher.get_model(position).state_dict()) for position in POSITIONS}
+
+
+def record_decisions(model, num_games, seed=0, exp_epsilon=0.1):
+    """
+    Self-play `num_games` seeded games with the teacher `model`,
+    dealt like the actors deal them (scored by the bid model),
+    exploring with probability `exp_epsilon`, and record every
+    decision with more than one legal action as (z, actions, x,
+    values) by position: the shared state rows and the action rows
+    of z_batch as int8, the shared x row and the teacher values.
+    """
+    np_state, py_state = np.random.get_state(), random.getstate()
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        env = ClientEnv('adp')
+        decisions = {position: [] for position in POSITIONS}
+        for _ in range(num_games):
+            obs, _, _ = env.reset(model, 'cpu')
+            done = False
+            while not done:
+                legal_actions = obs['legal_actions']
+                if len(legal_actions) > 1:
+                    z_batch = torch.from_numpy(obs['z_batch'])
+                    x_batch = torch.from_numpy(obs['x_batch'])
+                    with torch.no_grad():
+                        values = model.forward(obs['position'], z_batch, x_batch, True)['values'].flatten()
+                    decisions[obs['position']].append((z_batch[0, 1:].to(torch.int8), z_batch[:, 0].to(torch.int8),
+                                                       x_batch[0] if x_batch.dim() > 1 else x_batch, values))
+                    if random.random() < exp_epsilon:
+                        action = random.choice(legal_actions)
+                    else:
+                        action = legal_actions[int(torch.argmax(values))]
+                else:
+                    action = legal_actions[0]
+                obs, _, done, _ = env.step(action)
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+    return decisions
+
+
+def make_batch(decisions):
+    """
+    The (z_batch, x_batch, values, lengths) of recorded decisions
+    scored together.
+    """
+    z_batch = torch.cat([torch.cat([actions[:, None], z[None].expand(len(actions), -1, -1)], dim=1)
+                         for z, actions, _, _ in decisions]).float()
+    if decisions[0][2].shape[0] > 1:
+        x_batch = torch.cat([x[None].expand(len(actions), -1) for _, actions, x, _ in decisions])
+    else:
+        x_batch = decisions[0][2]
+    values = torch.cat([values for _, _, _, values in decisions])
+    return z_batch, x_batch, values, [len(actions) for _, actions, _, _ in decisions]
+
+
+def make_student(position, flags):
+    landlord = position == 'landlord'
+    return StudentModel(z_rows=40 if landlord else 37, use_x=landlord,
+                        channels=flags.student_channels, hidden=flags.student_hidden)
+
+
+def train_student(student, decisions, epochs, decisions_per_batch=64, lr=1e-3):
+    """
+    Fit `student` to the teacher values of `decisions` with a mean
+    squared error. Returns the loss of the last epoch.
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    student.train()
+    loss = 0.0
+    for epoch in range(epochs):
+        order = np.random.permutation(len(decisions))
+        losses = []
+        for start in range(0, len(order), decisions_per_batch):
+            z_batch, x_batch, values, _ = make_batch([decisions[k] for k in order[start:start + decisions_per_batch]])
+            output = student.forward(z_batch, x_batch, return_value=True)['values'].flatten()
+            batch_loss = F.mse_loss(output, values)
+            optimizer.zero_grad()
+            batch_loss.backward()
+            optimizer.step()
+            losses.append(float(batch_loss))
+        loss = float(np.mean(losses))
+    student.eval()
+    return loss
+
+
+def evaluate_student(teacher, student, decisions):
+    """
+    The fraction of `decisions` where the student picks the
+    teacher's action, and the microseconds per decision of both.
+    """
+    samples = [make_batch([decision])[:2] for decision in decisions]
+    _, agreement = check_equivalence(_eager_values(teacher), _eager_values(student), samples)
+    teacher_us = benchmark_latency(_eager_values(teacher), samples, repeat=1)
+    student_us = benchmark_latency(_eager_values(student), samples, repeat=1)
+    return agreement, teacher_us, student_us
+
+
+def _load_or_record(flags, teacher, teacher_hashes):
+    """
+    The decisions recorded in `flags.distill_file`, recorded again if
+    the file is missing or was recorded with other teacher weights.
+    """
+    if os.path.exists(flags.distill_file):
+        recorded = torch.load(flags.distill_file)
+        if recorded.get('teacher') == teacher_hashes:
+            print("读取已录制的对局:", flags.distill_file)
+            return recorded
+        print("已录制的对局来自其他模型，重新录制:", flags.distill_file)
+    print("录制自我对局中: %d 局" % flags.distill_games)
+    recorded = dict(teacher=teacher_hashes,
+                    train=record_decisions(teacher, flags.distill_games, seed=0),
+                    held_out=record_decisions(teacher, max(flags.distill_games // 4, 1), seed=1))
+    torch.save(recorded, flags.distill_file)
+    return recorded
+
+
+def distill(flags, directory='./models'):
+    """
+    Record (or reuse) self-play decisions, train a student per
+    position and save it to `<directory>/<position>_student.ckpt`.
+    Returns the held-out agreement and speedup of every position.
+    """
+    teacher = _load_teacher()
+    teacher_hashes = _teacher_hashes(teacher)
+    recorded = _load_or_record(flags, teacher, teacher_hashes)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    report = {}
+    for position in POSITIONS:
+        student = make_student(position, flags)
+        loss = train_student(student, recorded['train'][position], flags.distill_epochs)
+        agreement, teacher_us, student_us = evaluate_student(
+            teacher.get_model(position), student, recorded['held_out'][position])
+        save_student(student, student_path(directory, position), teacher_hashes[position])
+        report[position] = dict(loss=loss, agreement=agreement, speedup=teacher_us / student_us)
+        print("蒸馏 %s: 训练误差 %.4f, 动作一致率 %.1f%%, 每次决策 %.0fus -> %.0fus (%.1fx)" % (
+            position, loss, agreement * 100, teacher_us, student_us, teacher_us / student_us))
+    print("学生模型已保存到 %s，使用 --actor_student 让Actor使用学生模型" % directory)
+    return report
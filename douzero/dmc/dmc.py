@@ -8,14 +8,17 @@ from collections import deque
 import warnings
 
 import torch
-from torch import multiprocessing as mp
 from torch import nn
 import pickle
 import random
 
 from .file_writer import FileWriter
-from .models import Model, MingpaiModels
-from .utils import get_batch, log, create_env, create_optimizers, act
+from .models import Model, MingpaiModels, load_weights
+from .utils import BatchCollector, log, create_buffers, create_optimizers, \
+    create_stage_stats, read_stage_stats, format_stage_stats, format_fill_stats, get_context
+from .inference import create_inference
+from .supervisor import ActorSupervisor, create_held_buffers
+from .export import export_models, check_factorized
 import client_helper
 import bit_helper
 import requests
@@ -35,7 +38,12 @@ def compute_loss(logits, targets):
 
 batches = []
 program_version = "4.1.0"
-updating = False
+update_lock = threading.Lock()
+# Seconds an update keeps update_lock after publishing. Actors
+# switch slots at their next forward; one that started on the old
+# slot just before the switch is done long before this, and only
+# then may the next update load weights into that slot.
+SWAP_GRACE_SECONDS = 10
 
 def learn(position, actor_models, model, batch, optimizer, flags, lock):
     global model_version, models, batches
@@ -75,18 +83,39 @@ def train(flags):
         device_iterator = range(flags.num_actor_devices)
         assert flags.num_actor_devices <= len(flags.gpu_devices.split(',')), 'The number of actor devices can not exceed the number of available devices'
 
-    def update_model(ver, urls, force):
-        global model_version, models, updating
-        if updating:
+    def publish_models():
+        """
+        Export the weights loaded into the staged slots for the actor
+        backend and make them active, the actors pick them up at
+        their next decision.
+        """
+        if flags.actor_backend != 'eager':
+            export_models(models[device_iterator[0]], flags, staged=True)
+        for device in device_iterator:
+            models[device].bump_version()
+
+    def update_model(ver, urls, force, grace=False):
+        # One update at a time: the staged slot is the one the actors
+        # played with until the last publish. An update that comes
+        # while another is in flight is dropped, the upload loop
+        # asks again since model_version has not changed. Only
+        # updates made while actors run need the grace period.
+        if not update_lock.acquire(blocking=False):
+            print("上一次模型更新尚未完成，跳过本次更新")
             return
-        updating = True
+        try:
+            _update_model(ver, urls, force, grace)
+        finally:
+            update_lock.release()
+
+    def _update_model(ver, urls, force, grace):
+        global model_version, models
         if model_version != ver or force:
             print("检测到模型更新")
             if len(urls) > 0:
                 url = urls[random.randint(0, len(urls)-1)]
             else:
                 print("模型更新失败：没有有效的模型地址")
-                updating = False
                 return
             print("更新中，请耐心等待")
             st = time.time()
@@ -95,21 +124,25 @@ def train(flags):
             # with open("model_resnet.pkl", "rb") as f:
             #     weights = pickle.load(f)
             if weights is not None:
-                model_version = ver
                 for position in ["landlord", "landlord_up", "landlord_down"]:
                     if flags.actor_device_cpu:
-                        models["cpu"].get_model(position).load_state_dict(weights[position])
+                        models["cpu"].load_state_dict(position, weights[position])
                         torch.save(weights[position], "./models/" + position + ".ckpt")
                     else:
                         for device in range(flags.num_actor_devices):
-                            models[device].get_model(position).load_state_dict(weights[position])
+                            models[device].load_state_dict(position, weights[position])
                             torch.save(weights[position], "./models/" + position + ".ckpt")
+                publish_models()
+                # Batches are tagged with the new version only once
+                # the actors play with it
+                model_version = ver
                 with open("./model_version.txt", "w") as f:
                     f.write(str(model_version))
                 print("更新模型成功！耗时: %.1f s" % (time.time() - st))
+                if grace:
+                    time.sleep(SWAP_GRACE_SECONDS)
             else:
                 print("更新模型失败！")
-        updating = False
 
     def load_actor_models():
         global model_version, models
@@ -151,15 +184,23 @@ def train(flags):
     global models
     models = {}
     for device in device_iterator:
-        model = MingpaiModels(device="cpu")
+        model = MingpaiModels(device=device)
         model.share_memory()
         model.eval()
         models[device] = model
 
+    # Initialize buffers
+    buffers = create_buffers(flags, device_iterator)
+
     # Initialize queues
-    actor_processes = []
-    ctx = mp.get_context('spawn')
-    batch_queues = {"landlord": ctx.SimpleQueue(), "landlord_up": ctx.SimpleQueue(), "landlord_down": ctx.SimpleQueue(), "bidding": ctx.SimpleQueue()}
+    ctx = get_context(flags)
+    free_queue = {}
+    full_queue = {}
+    for device in device_iterator:
+        _free_queue = {'landlord': ctx.SimpleQueue(), 'landlord_up': ctx.SimpleQueue(), 'landlord_down': ctx.SimpleQueue()}
+        _full_queue = {'landlord': ctx.SimpleQueue(), 'landlord_up': ctx.SimpleQueue(), 'landlord_down': ctx.SimpleQueue()}
+        free_queue[device] = _free_queue
+        full_queue[device] = _full_queue
 
     # Learner model for training
     learner_model = None
@@ -187,22 +228,41 @@ def train(flags):
         load_actor_models()
     for position in ["landlord", "landlord_up", "landlord_down"]:
         if flags.actor_device_cpu:
-            models["cpu"].get_model(position).load_state_dict(torch.load("./models/" + position + ".ckpt", map_location="cpu"))
+            models["cpu"].load_state_dict(position, load_weights("./models/" + position + ".ckpt"))
         else:
             for device in device_iterator:
-                models[device].get_model(position).load_state_dict(torch.load("./models/" + position + ".ckpt", map_location="cuda:"+str(device)))
+                models[device].load_state_dict(position, load_weights("./models/" + position + ".ckpt"))
+    publish_models()
+    if flags.factorize_first_layer and not check_factorized(models[device_iterator[0]], flags):
+        flags.factorize_first_layer = False
+
+    # Starting inference workers
+    supervisor = ActorSupervisor(ctx, flags)
+    inference_clients = [None for _ in range(flags.num_actors)]
+    if flags.num_inference_workers > 0:
+        if flags.actor_device_cpu:
+            request_queues, inference_clients = create_inference(flags, flags.num_actors, ctx)
+            for i in range(flags.num_inference_workers):
+                supervisor.add_inference_worker(i, (i, request_queues[i], inference_clients, models["cpu"], flags))
+        else:
+            print("推理服务仅支持CPU Actor，已忽略 --num_inference_workers")
+
+    # Per-stage timing of the actors of every device
+    stage_stats = {}
+    for device in device_iterator:
+        stage_stats[device] = None if flags.disable_stage_timing else create_stage_stats(ctx, flags.num_actors)
 
     # Starting actor processes
     if flags.actor_device_cpu:
         flags.num_actor_devices = 1
     for device in device_iterator:
         num_actors = flags.num_actors
+        held_buffers = create_held_buffers(ctx, flags.num_actors)
         for i in range(flags.num_actors):
-            actor = ctx.Process(
-                target=act,
-                args=(i, device, batch_queues, models[device], flags))
-            actor.start()
-            actor_processes.append(actor)
+            supervisor.add(device, i, free_queue[device], held_buffers,
+                           args=(i, device, free_queue[device], full_queue[device], models[device], buffers[device],
+                                 flags, inference_clients[i], stage_stats[device]))
+    supervisor.start()
 
     def upload_batch_loop(flags):
         global model_version, models
@@ -213,12 +273,12 @@ def train(flags):
                     my_batches.extend(batches)
                     batches.clear()
                     ver, urls = client_helper.handle_batches(my_batches, model_version, program_version, flags)
-                    st = time.time()
                     if len(urls) > 0:
                         if ver != model_version:
                             print("新模型:", ver)
-                            update_model(ver, urls, True)
-                            print("更新完成！耗时: %.1f s" % (time.time() - st))
+                            # Download and load in the background so
+                            # that uploading goes on meanwhile
+                            threading.Thread(target=update_model, args=(ver, urls, True, True), daemon=True).start()
                     else:
                         print("没有收到模型下载地址")
                 else:
@@ -266,12 +326,21 @@ def train(flags):
 
 
 
-    def batch_and_learn(i, device, position, local_lock, position_lock, lock=threading.Lock()):
+    # One collector per device and position
+    collectors = {}
+    for device in device_iterator:
+        collectors[device] = {
+            position: BatchCollector(free_queue[device][position], full_queue[device][position],
+                                     buffers[device][position], flags)
+            for position in ['landlord', 'landlord_up', 'landlord_down']
+        }
+
+    def batch_and_learn(device, position, lock=threading.Lock()):
         """Thread target for the learning process."""
         nonlocal frames, position_frames, stats
         while frames < flags.total_frames:
-            batch = get_batch(batch_queues, position, flags, local_lock)
-            _stats = learn(position, models, None, batch, None, flags, position_lock)
+            batch = collectors[device][position].get()
+            _stats = learn(position, models, None, batch, None, flags, None)
             with lock:
                 for k in _stats:
                     stats[k] = _stats[k]
@@ -288,19 +357,19 @@ def train(flags):
     thread_update_model.setDaemon(True)
     thread_update_model.start()
 
-    threads = []
-    locks = {}
     for device in device_iterator:
-        locks[device] = {'landlord': threading.Lock(), 'landlord_up': threading.Lock(), 'landlord_down': threading.Lock(), 'bidding': threading.Lock()}
-    position_locks = {'landlord': threading.Lock(), 'landlord_up': threading.Lock(), 'landlord_down': threading.Lock(), 'bidding': threading.Lock()}
+        for m in range(flags.num_buffers):
+            free_queue[device]['landlord'].put(m)
+            free_queue[device]['landlord_up'].put(m)
+            free_queue[device]['landlord_down'].put(m)
 
+    threads = []
     for device in device_iterator:
-        for i in range(flags.num_threads):
-            for position in ['landlord', 'landlord_up', 'landlord_down']:
-                thread = threading.Thread(
-                    target=batch_and_learn, name='batch-and-learn-%d' % i, args=(i,device,position,locks[device][position],position_locks[position]))
-                thread.start()
-                threads.append(thread)
+        for position in ['landlord', 'landlord_up', 'landlord_down']:
+            thread = threading.Thread(
+                target=batch_and_learn, name='batch-and-learn-%s-%s' % (str(device), position), args=(device, position))
+            thread.start()
+            threads.append(thread)
 
     def checkpoint(frames):
         if flags.disable_checkpoint:
@@ -324,6 +393,10 @@ def train(flags):
 
     fps_log = []
     timer = timeit.default_timer
+    last_stage_stats = {device: read_stage_stats(stage_stats[device])
+                        for device in device_iterator if stage_stats[device] is not None}
+    last_fill_stats = {device: {position: collector.stats() for position, collector in collectors[device].items()}
+                       for device in device_iterator}
     try:
         last_checkpoint_time = timer() - flags.save_interval * 60
         while frames < flags.total_frames:
@@ -348,6 +421,22 @@ def train(flags):
             position_fps = {k: (position_frames[k] - position_start_frames[k]) / (end_time - start_time) for k in
                             position_frames}
             log.info("本机速度 %.1f fps", fps_avg)
+            crash_counts = supervisor.crash_counts()
+            if crash_counts:
+                log.info("Actor崩溃次数: %s", ', '.join('%s-%d: %d' % (str(device), i, n)
+                                                    for (device, i), n in crash_counts.items()))
+            for device in last_fill_stats:
+                current_fill_stats = {position: collector.stats() for position, collector in collectors[device].items()}
+                fill_report = format_fill_stats(current_fill_stats, last_fill_stats[device])
+                if fill_report:
+                    log.info("Batch收集 (%s): %s", str(device), fill_report)
+                last_fill_stats[device] = current_fill_stats
+            for device in last_stage_stats:
+                current_stage_stats = read_stage_stats(stage_stats[device])
+                stage_report = format_stage_stats(current_stage_stats, last_stage_stats[device])
+                if stage_report:
+                    log.info("Actor各阶段耗时 (%s): %s", str(device), stage_report)
+                last_stage_stats[device] = current_stage_stats
             if fps_avg == 0:
                 print("本机速度在训练的前几分钟为0是正常现象，请稍后")
             # log.info('After %i (L:%i U:%i D:%i) frames: @ %.1f fps (avg@ %.1f fps) (L:%.1f U:%.1f D:%.1f) Stats:\n%s',
@@ -91,3 +91,94 @@ class Environment:
 
     def close(self):
         self.env.close()
+
+
+class VecEnvironment:
+    def __init__(self, envs, device, inference=None):
+        """ Wrap several environments that are played by one actor.
+        The pending decisions of all the games that wait on the same
+        position model are scored with a single forward, or sent to
+        the inference server if an `inference` client is given.
+        """
+        self.envs = [Environment(env, device) for env in envs]
+        self.device = device
+        self.inference = inference
+        self.positions = [None for _ in self.envs]
+        self.obs = [None for _ in self.envs]
+        self.env_outputs = [None for _ in self.envs]
+
+    def __len__(self):
+        return len(self.envs)
+
+    def initial(self, model, device, flags=None):
+        for k, env in enumerate(self.envs):
+            self.positions[k], self.obs[k], self.env_outputs[k] = env.initial(model, device, flags=flags)
+        return self.positions, self.obs, self.env_outputs
+
+    def _best_actions(self, model, requests, flags=None):
+        """
+        The index of the best legal action of every pending decision.
+        The legal-action batches of the games waiting on the same
+        position are concatenated into one forward and the values
+        are split back per game. Decisions the inference server
+        does not answer in time are scored with `model`.
+        """
+        if self.inference is not None and self.inference.fits(requests):
+            best = self.inference.best_actions(requests)
+            if best is not None:
+                return best
+        best = []
+        for position, z_batch, x_batch, lengths in requests:
+            with torch.no_grad():
+                if flags is not None and flags.factorize_first_layer:
+                    values = model.forward_factorized(position, z_batch, x_batch, lengths, True, flags=flags)['values']
+                else:
+                    values = model.forward(position, z_batch, x_batch, True, flags=flags)['values']
+            values = values.flatten().cpu()
+            start = 0
+            for length in lengths:
+                best.append(int(torch.argmax(values[start:start + length])))
+                start += length
+        return best
+
+    def select_actions(self, model, flags=None):
+        """
+        Choose an action for every game, exploring with probability
+        `flags.exp_epsilon`.
+        """
+        actions = [None for _ in self.envs]
+        requests, order = [], []
+        for position in ['landlord', 'landlord_up', 'landlord_down']:
+            pending = []
+            for k, obs in enumerate(self.obs):
+                if self.positions[k] != position:
+                    continue
+                if len(obs['legal_actions']) > 1:
+                    pending.append(k)
+                else:
+                    actions[k] = obs['legal_actions'][0]
+            if len(pending) == 0:
+                continue
+            z_batch = torch.cat([self.obs[k]['z_batch'] for k in pending])
+            x_batch = torch.cat([self.obs[k]['x_batch'] for k in pending])
+            requests.append((position, z_batch, x_batch,
+                             [len(self.obs[k]['legal_actions']) for k in pending]))
+            order.extend(pending)
+        if len(requests) == 0:
+            return actions
+        best = self._best_actions(model, requests, flags=flags)
+        for k, action_idx in zip(order, best):
+            legal_actions = self.obs[k]['legal_actions']
+            if flags is not None and flags.exp_epsilon > 0 and np.random.rand() < flags.exp_epsilon:
+                action_idx = int(torch.randint(len(legal_actions), (1,))[0])
+            actions[k] = legal_actions[action_idx]
+        return actions
+
+    def step(self, actions, model, device, flags=None):
+        for k, env in enumerate(self.envs):
+            self.positions[k], self.obs[k], self.env_outputs[k] = env.step(actions[k], model, device, flags=flags)
+        return self.positions, self.obs, self.env_outputs
+
+    def close(self):
+        for env in self.envs:
+            env.close()
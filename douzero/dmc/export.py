@@ -0,0 +1,483 @@
+"""
+Export of the actor models for inference. Every BatchNorm is
+folded into the convolution before it, the activations are applied
+in place, and the result is traced and frozen into a TorchScript
+module, optionally with its linear layers quantized to int8, or
+exported to ONNX for ONNX Runtime (an optional dependency). The
+exported modules are checked against the eager models on recorded
+decisions before they are published to the actors.
+"""
+import abc
+import copy
+import functools
+import os
+import random
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from douzero.env import Env
+from .models import GeneralModel, StudentModel, load_weights, state_dict_hash
+
+POSITIONS = ['landlord', 'landlord_up', 'landlord_down']
+ACTOR_BACKENDS = ['eager', 'torchscript', 'int8', 'onnx']
+
+
+def fold_conv_bn(conv, bn):
+    """
+    A Conv1d with bias computing bn(conv(x)) for a BatchNorm in
+    eval mode.
+    """
+    folded = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                       stride=conv.stride, padding=conv.padding, bias=True)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight * scale[:, None, None])
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+class FoldedBlock(nn.Module):
+    def __init__(self, block):
+        """
+        A BasicBlock with its BatchNorms folded into the convolutions.
+        """
+        super().__init__()
+        self.conv1 = fold_conv_bn(block.conv1, block.bn1)
+        self.conv2 = fold_conv_bn(block.conv2, block.bn2)
+        self.has_shortcut = len(block.shortcut) > 0
+        if self.has_shortcut:
+            self.shortcut = fold_conv_bn(block.shortcut[0], block.shortcut[1])
+        else:
+            self.shortcut = nn.Identity()
+
+    def forward(self, x):
+        out = F.relu_(self.conv1(x))
+        out = self.conv2(out)
+        out += self.shortcut(x)
+        return F.relu_(out)
+
+
+class FoldedModel(nn.Module):
+    def __init__(self, model):
+        """
+        The inference-only version of a GeneralModel or MingpaiModel
+        returning the values of the actions.
+        """
+        super().__init__()
+        self.use_x = isinstance(model, GeneralModel)
+        self.conv1 = fold_conv_bn(model.conv1, model.bn1)
+        self.blocks = nn.Sequential(*[FoldedBlock(block)
+                                      for layer in (model.layer1, model.layer2, model.layer3)
+                                      for block in layer])
+        self.linears = nn.ModuleList([module for name, module in sorted(model.named_children())
+                                      if name.startswith('linear')])
+
+    def forward(self, z, x):
+        out = F.relu_(self.conv1(z))
+        out = self.blocks(out)
+        out = out.flatten(1, 2)
+        if self.use_x:
+            out = torch.cat([x, x, x, x, out], dim=-1)
+        for linear in self.linears:
+            out = F.leaky_relu_(linear(out))
+        return out
+
+
+def export_torchscript(model, z, x, quantize=False):
+    """
+    Fold, trace and freeze an eval-mode model, using (z, x) as the
+    example decision. With `quantize`, the linear layers are
+    dynamically quantized to int8 before tracing.
+    """
+    folded = FoldedModel(copy.deepcopy(model).cpu().eval()).eval()
+    if quantize:
+        folded = torch.ao.quantization.quantize_dynamic(folded, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        scripted = torch.jit.freeze(torch.jit.trace(folded, (z, x)))
+    return scripted
+
+
+def sample_decisions(num_games=4, seed=0):
+    """
+    The (z_batch, x_batch) inputs of every decision with more than
+    one legal action in `num_games` seeded random games, by
+    position. The global random state is left untouched.
+    """
+    np_state, py_state = np.random.get_state(), random.getstate()
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        env = Env('adp')
+        samples = {position: [] for position in POSITIONS}
+        for _ in range(num_games):
+            obs = env.reset(None, 'cpu')
+            done = False
+            while not done:
+                if len(obs['legal_actions']) > 1:
+                    samples[obs['position']].append((torch.from_numpy(obs['z_batch']),
+                                                     torch.from_numpy(obs['x_batch'])))
+                obs, _, done, _ = env.step(random.choice(obs['legal_actions']))
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+    return samples
+
+
+def _eager_values(model):
+    def forward(z, x):
+        return model.forward(z, x, True)['values']
+    return forward
+
+
+def check_equivalence(reference, candidate, decisions):
+    """
+    Compare the values of two forward functions on `decisions`.
+    Returns the largest absolute difference and the fraction of
+    decisions where both pick the same action.
+    """
+    max_diff, agree = 0.0, 0
+    with torch.no_grad():
+        for z, x in decisions:
+            expected, actual = reference(z, x), candidate(z, x)
+            max_diff = max(max_diff, float((expected - actual).abs().max()))
+            agree += int(torch.argmax(expected)) == int(torch.argmax(actual))
+    return max_diff, agree / max(len(decisions), 1)
+
+
+def benchmark_latency(forward, decisions, repeat=3):
+    """
+    Mean microseconds per decision of a forward function.
+    """
+    with torch.no_grad():
+        for z, x in decisions[:5]:
+            forward(z, x)
+        st = time.perf_counter()
+        for _ in range(repeat):
+            for z, x in decisions:
+                forward(z, x)
+    return (time.perf_counter() - st) / (repeat * max(len(decisions), 1)) * 1e6
+
+
+def check_factorized(model, flags, samples=None):
+    """
+    Compare the factorized first layer of the three models of a
+    MingpaiModels against their plain forward on sampled decisions,
+    scored together as the actors do. Returns True if every model
+    matches within `flags.export_tolerance`.
+    """
+    samples = samples or sample_decisions()
+    for position in POSITIONS:
+        eager = model.get_model(position)
+        z = torch.cat([z for z, _ in samples[position]])
+        x = torch.cat([x for _, x in samples[position]])
+        lengths = [z.shape[0] for z, _ in samples[position]]
+
+        def plain(z, x):
+            return eager.forward(z, x, True)['values']
+
+        def factorized(z, x):
+            return eager.forward_factorized(z, x, lengths, True)['values']
+        max_diff, _ = check_equivalence(plain, factorized, [(z, x)])
+        plain_us = benchmark_latency(plain, [(z, x)]) / len(lengths)
+        factorized_us = benchmark_latency(factorized, [(z, x)]) / len(lengths)
+        print("分解首层 %s: 最大误差 %.2e, 每次决策 %.0fus -> %.0fus" % (
+            position, max_diff, plain_us, factorized_us))
+        if max_diff > flags.export_tolerance:
+            print("分解首层与原模型不一致，继续使用原模型")
+            return False
+    return True
+
+
+# Batch sizes ONNX inputs are padded to; larger batches are padded
+# to the next power of two
+ONNX_BUCKETS = [8, 16, 32, 64, 128, 256, 512]
+
+
+def onnx_bucket(n):
+    """
+    The padded batch size of a batch of `n` legal actions. There
+    is one bucket per power of two above ONNX_BUCKETS, so that the
+    number of padded buffers kept by an OnnxRunner stays small.
+    """
+    for bucket in ONNX_BUCKETS:
+        if bucket >= n:
+            return bucket
+    return 1 << (n - 1).bit_length()
+
+
+class OnnxRunner:
+    def __init__(self, path, num_threads=1):
+        """
+        An ONNX Runtime session for one exported model. Batches are
+        padded to a few bucket sizes so that the session only ever
+        sees a handful of shapes, and the padded inputs of every
+        bucket are allocated once and reused.
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.buffers = {}
+
+    def _padded(self, name, value, bucket):
+        key = (name, bucket) + tuple(value.shape[1:])
+        if key not in self.buffers:
+            self.buffers[key] = np.zeros((bucket,) + tuple(value.shape[1:]), dtype=np.float32)
+        buffer = self.buffers[key]
+        buffer[:value.shape[0]] = value
+        return buffer
+
+    def __call__(self, z, x):
+        n = z.shape[0]
+        bucket = onnx_bucket(n)
+        inputs = {'z': z.numpy(), 'x': x.numpy()}
+        feed = {name: self._padded(name, inputs[name], bucket) for name in self.input_names}
+        values = self.session.run(None, feed)[0]
+        return torch.from_numpy(values[:n].copy())
+
+
+def export_onnx(model, z, x, path):
+    """
+    Fold an eval-mode model and export it to ONNX with a dynamic
+    batch dimension.
+    """
+    folded = FoldedModel(copy.deepcopy(model).cpu().eval()).eval()
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        torch.onnx.export(folded, (z, x), path, input_names=['z', 'x'], output_names=['values'],
+                          dynamic_axes={'z': {0: 'num_actions'}, 'x': {0: 'num_actions_x'},
+                                        'values': {0: 'num_actions'}},
+                          opset_version=17, dynamo=False)
+
+
+def _onnx_available():
+    try:
+        import onnxruntime
+        return True
+    except ImportError:
+        return False
+
+
+def _remove_exports(directory, suffix):
+    """
+    Remove the exports of every position, and the temporary files
+    of an export that was not published.
+    """
+    for position in POSITIONS:
+        path = os.path.join(directory, position + suffix)
+        for name in (path, path + '.tmp'):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def _export_position(eager, z, x, flags, directory, position):
+    """
+    Export one model for the actor backend. Returns the forward
+    function of the export and a function that publishes it.
+    """
+    if flags.actor_backend == 'onnx':
+        path = os.path.join(directory, position + '.onnx')
+        export_onnx(eager, z, x, path + '.tmp')
+        runner = OnnxRunner(path + '.tmp', onnx_threads(flags))
+        return runner, lambda: os.replace(path + '.tmp', path)
+    path = os.path.join(directory, position + '.pt')
+    scripted = export_torchscript(eager, z, x)
+
+    def publish(module=scripted):
+        torch.jit.save(module, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    return scripted, publish
+
+
+def export_models(model, flags, directory='./models', samples=None, staged=False):
+    """
+    Export the three models of a MingpaiModels for the actor
+    backend, to `<directory>/<position>.pt` (TorchScript) or
+    `<directory>/<position>.onnx`. Unless every exported model
+    matches its eager model within `flags.export_tolerance`, the old
+    exports are removed instead so that actors fall back to the
+    eager models. Returns True if the models were written.
+
+    With the int8 backend, a quantized export of a position is used
+    only if it picks the same action as the eager model on at least
+    `flags.quantize_min_agreement` of the decisions of held-out
+    games; otherwise the fp32 export of that position is used.
+
+    If `staged`, the weights loaded into the staged slot of `model`
+    are exported, so that the exports are in place before the slot
+    is made active.
+    """
+    suffix = '.onnx' if flags.actor_backend == 'onnx' else '.pt'
+    if flags.actor_backend == 'onnx' and not _onnx_available():
+        print("未安装onnxruntime，使用PyTorch运行模型")
+        _remove_exports(directory, suffix)
+        return False
+    samples = samples or sample_decisions()
+    if flags.actor_backend == 'int8':
+        held_out = sample_decisions(seed=1)
+    published = []
+    for position in POSITIONS:
+        eager = model.get_model(position, staged)
+        z, x = samples[position][0]
+        exported, publish = _export_position(eager, z, x, flags, directory, position)
+        max_diff, agreement = check_equivalence(_eager_values(eager), exported, samples[position])
+        eager_us = benchmark_latency(_eager_values(eager), samples[position])
+        exported_us = benchmark_latency(exported, samples[position])
+        print("导出 %s (%s): 最大误差 %.2e, 动作一致率 %.1f%%, 每次决策 %.0fus -> %.0fus" % (
+            position, flags.actor_backend, max_diff, agreement * 100, eager_us, exported_us))
+        if max_diff > flags.export_tolerance:
+            print("导出模型与原模型不一致，继续使用原模型")
+            _remove_exports(directory, suffix)
+            return False
+        if flags.actor_backend == 'int8':
+            quantized = export_torchscript(eager, z, x, quantize=True)
+            _, agreement = check_equivalence(_eager_values(eager), quantized, held_out[position])
+            quantized_us = benchmark_latency(quantized, held_out[position])
+            eager_us = benchmark_latency(_eager_values(eager), held_out[position])
+            print("量化 %s: 动作一致率 %.1f%%, 加速 %.2fx" % (position, agreement * 100, eager_us / quantized_us))
+            if agreement >= flags.quantize_min_agreement:
+                publish = functools.partial(publish, quantized)
+            else:
+                print("%s 量化后一致率过低，使用未量化的导出模型" % position)
+        published.append(publish)
+    for publish in published:
+        publish()
+    return True
+
+
+def onnx_threads(flags):
+    return flags.actor_threads if flags.actor_threads > 0 else 1
+
+
+class ExportedModels(abc.ABC):
+    def __init__(self, model, device, directory='./models'):
+        """
+        The actor view of exported models. The files are loaded
+        again whenever the version of the shared eager `model` is
+        bumped; until they can be loaded the eager model is used.
+        """
+        self.model = model
+        self.device = device if device == "cpu" else 'cuda:' + str(device)
+        self.directory = directory
+        self.version = None
+        self.runners = None
+
+    @abc.abstractmethod
+    def _load(self, position):
+        """
+        The forward function of the export of `position`.
+        """
+
+    def _reload(self):
+        self.version = self.model.get_version()
+        try:
+            self.runners = {position: self._load(position) for position in POSITIONS}
+        except Exception as e:
+            print("加载导出模型失败，使用原模型:", repr(e))
+            self.runners = None
+
+    def forward(self, position, z, x, training=False, flags=None, debug=False):
+        if self.model.get_version() != self.version:
+            self._reload()
+        if self.runners is None:
+            return self.model.forward(position, z, x, training, flags, debug)
+        values = self.runners[position](z, x)
+        if training:
+            return dict(values=values)
+        if flags is not None and flags.exp_epsilon > 0 and np.random.rand() < flags.exp_epsilon:
+            action = torch.randint(values.shape[0], (1,))[0]
+        else:
+            action = torch.argmax(values, dim=0)[0]
+        return dict(action=action, max_value=torch.max(values))
+
+    def forward_factorized(self, position, z, x, lengths=None, training=False, flags=None):
+        # The exports score the whole batch, only the eager
+        # fallback is factorized
+        if self.model.get_version() != self.version:
+            self._reload()
+        if self.runners is None:
+            return self.model.forward_factorized(position, z, x, lengths, training, flags)
+        return self.forward(position, z, x, training, flags)
+
+    def get_model(self, position):
+        return self.model.get_model(position)
+
+
+class ScriptedModels(ExportedModels):
+    def _load(self, position):
+        return torch.jit.load(os.path.join(self.directory, position + '.pt'), map_location=self.device)
+
+
+class OnnxModels(ExportedModels):
+    def __init__(self, model, device, num_threads=1, directory='./models'):
+        super().__init__(model, device, directory)
+        self.num_threads = num_threads
+
+    def _load(self, position):
+        return OnnxRunner(os.path.join(self.directory, position + '.onnx'), self.num_threads)
+
+
+def student_path(directory, position):
+    return os.path.join(directory, position + '_student.ckpt')
+
+
+def save_student(student, path, teacher):
+    """
+    Save `student` with the `state_dict_hash` of the weights of the
+    teacher it was distilled from.
+    """
+    torch.save(dict(config=student.config, state_dict=student.state_dict(), teacher=teacher), path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_student(path, device='cpu', teacher=None):
+    """
+    The student saved at `path`. If the `state_dict_hash` of the
+    current teacher weights is given, a student distilled from other
+    weights raises a ValueError.
+    """
+    checkpoint = load_weights(path)
+    if teacher is not None and checkpoint.get('teacher') != teacher:
+        raise ValueError('%s was distilled from other teacher weights, run --distill again' % path)
+    student = StudentModel(**checkpoint['config'])
+    student.load_state_dict(checkpoint['state_dict'])
+    return student.to(device).eval()
+
+
+class StudentModels(ExportedModels):
+    """
+    Actors scoring their moves with the distilled students, see
+    `douzero.dmc.distill`. Students distilled from other weights than
+    the current ones are not loaded, the eager model is used instead.
+    """
+    def _load(self, position):
+        teacher = state_dict_hash(self.model.get_model(position).state_dict())
+        return _eager_values(load_student(student_path(self.directory, position), self.device, teacher))
+
+
+def get_actor_model(model, flags, device):
+    """
+    The model an actor scores its moves with, following
+    `flags.actor_student` and `flags.actor_backend`.
+    """
+    if flags.actor_student:
+        return StudentModels(model, device)
+    if flags.actor_backend in ('torchscript', 'int8'):
+        return ScriptedModels(model, device)
+    if flags.actor_backend == 'onnx':
+        if device != "cpu" or not _onnx_available():
+            print("ONNX后端不可用，使用PyTorch运行模型")
+            return model
+        return OnnxModels(model, device, onnx_threads(flags))
+    return model
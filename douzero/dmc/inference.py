@@ -0,0 +1,199 @@
+"""
+A central inference server for CPU actors. Instead of every actor
+running small forwards on its own copy of the models, actors write
+the legal-action batches of their pending decisions into a slot of
+shared memory and send a short request. Inference workers collect
+requests until the batch is full or the wait time is up, run one
+forward per position model and reply with the index of the best
+action of every decision. An actor that gets no reply in time
+scores its decisions with its own model.
+"""
+import os
+import queue
+import time
+import traceback
+
+import torch
+
+from .utils import log
+from .export import get_actor_model
+
+POSITIONS = ['landlord', 'landlord_up', 'landlord_down']
+Z_ROWS = 40
+X_COLUMNS = 15
+# Seconds an actor scores with its own model after a request timed
+# out, before it tries the inference workers again
+RETRY_SECONDS = 30
+
+
+class InferenceSlot:
+    def __init__(self, max_rows):
+        """
+        The shared tensors one actor writes the stacked legal-action
+        rows of its requests into.
+        """
+        self.max_rows = max_rows
+        self.z = torch.zeros((max_rows, Z_ROWS, 54)).share_memory_()
+        self.x = torch.zeros((max_rows, X_COLUMNS)).share_memory_()
+
+
+class InferenceClient:
+    def __init__(self, actor_id, slot, request_queue, reply_queue, timeout):
+        """
+        The actor side of the inference server. A request that is
+        not answered within `timeout` seconds is given up, and the
+        workers are not asked again for RETRY_SECONDS.
+        """
+        self.actor_id = actor_id
+        self.slot = slot
+        self.request_queue = request_queue
+        self.reply_queue = reply_queue
+        self.timeout = timeout
+        self.retry_at = 0.0
+        self.count = 0
+
+    def fits(self, requests):
+        if time.perf_counter() < self.retry_at:
+            return False
+        rows = sum(z.shape[0] for _, z, _, _ in requests)
+        return rows <= self.slot.max_rows
+
+    def best_actions(self, requests):
+        """
+        `requests` is a list of (position, z_batch, x_batch, lengths)
+        where the batches hold the legal actions of several decisions
+        of one position, `lengths` rows each. Returns the index of
+        the best action of every decision, in order, or None if no
+        worker answered in time.
+        """
+        segments = []
+        row = 0
+        for position, z_batch, x_batch, lengths in requests:
+            n = z_batch.shape[0]
+            self.slot.z[row:row + n, :z_batch.shape[1]] = z_batch
+            if x_batch.dim() == 2:
+                self.slot.x[row:row + n] = x_batch
+            segments.append((position, row, z_batch.shape[1], list(lengths)))
+            row += n
+        # Requests are tagged so that late replies, to requests given
+        # up on or left pending by a crashed predecessor, are skipped
+        self.count += 1
+        tag = (os.getpid(), self.count)
+        self.request_queue.put((self.actor_id, tag, segments))
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            try:
+                reply_tag, indices = self.reply_queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                log.warning('Actor %i: no reply from the inference workers in %.1f s, '
+                            'scoring with the local model for %d s', self.actor_id, self.timeout, RETRY_SECONDS)
+                self.retry_at = time.perf_counter() + RETRY_SECONDS
+                return None
+            if reply_tag == tag:
+                return indices
+
+
+def create_inference(flags, num_actors, ctx):
+    """
+    Create a request queue per inference worker, and the reply
+    queues and the slots of `num_actors` actors. Actor i sends its
+    requests to worker i % num_inference_workers, so that a worker
+    that dies only affects its own queue. Returns the request queues
+    and a list of clients, one per actor.
+    """
+    request_queues = [ctx.Queue() for _ in range(flags.num_inference_workers)]
+    clients = []
+    for i in range(num_actors):
+        slot = InferenceSlot(flags.inference_max_rows)
+        clients.append(InferenceClient(i, slot, request_queues[i % len(request_queues)], ctx.Queue(),
+                                       flags.inference_timeout))
+    return request_queues, clients
+
+
+def release_reader(request_queue):
+    """
+    Free the reader lock of the request queue of a dead worker. A
+    worker killed while it waits for requests leaves the lock taken,
+    and its restarted successor would block on it forever. Only call
+    this when no process reads from the queue.
+    """
+    # Taken either by us or by the dead worker, free afterwards
+    request_queue._rlock.acquire(False)
+    request_queue._rlock.release()
+
+
+def _collect(request_queue, max_batch, max_wait):
+    """
+    Block for the first request, then keep taking requests until
+    `max_batch` rows are pending or `max_wait` seconds have passed.
+    """
+    pending = [request_queue.get()]
+    rows = sum(sum(lengths) for _, _, _, lengths in pending[0][2])
+    deadline = time.perf_counter() + max_wait
+    while rows < max_batch:
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+            break
+        try:
+            request = request_queue.get(timeout=timeout)
+        except queue.Empty:
+            break
+        pending.append(request)
+        rows += sum(sum(lengths) for _, _, _, lengths in request[2])
+    return pending
+
+
+def serve(worker_id, request_queue, clients, model, flags):
+    """
+    Inference worker loop. `clients` is indexed by actor id and
+    `model` is the shared `MingpaiModels` the actors would use.
+    """
+    torch.set_num_threads(flags.inference_threads)
+    model = get_actor_model(model, flags, 'cpu')
+    max_wait = flags.inference_max_wait / 1000
+    try:
+        log.info('Inference worker %i started.', worker_id)
+        while True:
+            pending = _collect(request_queue, flags.inference_batch_size, max_wait)
+            # Decisions are answered in the order of the segments of
+            # each request, whatever position they belong to. An actor
+            # can have several requests pending (a late one it gave up
+            # on and a new one), so results are kept per request.
+            results = {}
+            parts = {position: [] for position in POSITIONS}
+            for actor_id, tag, segments in pending:
+                offset = 0
+                for position, row, z_rows, lengths in segments:
+                    parts[position].append(((actor_id, tag), row, z_rows, lengths, offset))
+                    offset += len(lengths)
+                results[(actor_id, tag)] = [0] * offset
+            for position in POSITIONS:
+                if len(parts[position]) == 0:
+                    continue
+                z_batch = torch.cat([clients[key[0]].slot.z[row:row + sum(lengths), :z_rows]
+                                     for key, row, z_rows, lengths, _ in parts[position]])
+                x_batch = torch.cat([clients[key[0]].slot.x[row:row + sum(lengths)]
+                                     for key, row, z_rows, lengths, _ in parts[position]])
+                with torch.no_grad():
+                    if flags.factorize_first_layer:
+                        lengths = [length for _, _, _, lengths, _ in parts[position] for length in lengths]
+                        values = model.forward_factorized(position, z_batch, x_batch, lengths, True, flags=flags)['values']
+                    else:
+                        values = model.forward(position, z_batch, x_batch, True, flags=flags)['values']
+                values = values.flatten()
+                start = 0
+                for key, _, _, lengths, offset in parts[position]:
+                    for j, length in enumerate(lengths):
+                        results[key][offset + j] = int(torch.argmax(values[start:start + length]))
+                        start += length
+            # The indices travel with the reply, so a late answer to
+            # an old request never overwrites the one of a new request
+            for (actor_id, tag), indices in results.items():
+                clients[actor_id].reply_queue.put((tag, indices))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.error('Exception in inference worker %i', worker_id)
+        traceback.print_exc()
+        print()
+        raise e
@@ -2,6 +2,10 @@
 This file includes the torch models. We wrap the three
 models into one class for convenience.
 """
+import hashlib
+import io
+import os
+from collections import OrderedDict
 
 import numpy as np
 
@@ -9,6 +13,21 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+def _lstm_history(lstm, z, batch_size):
+    """
+    The last LSTM output of the history `z` for every row of a
+    batch of `batch_size` legal actions. `z` is either one history
+    shared by all the actions, (1, T, 162) or (T, 162), which runs
+    the LSTM once, or a batch of histories.
+    """
+    if z.dim() == 2:
+        z = z.unsqueeze(0)
+    lstm_out, _ = lstm(z)
+    lstm_out = lstm_out[:,-1,:]
+    if lstm_out.shape[0] != batch_size:
+        lstm_out = lstm_out.expand(batch_size, -1)
+    return lstm_out
+
 class LandlordLstmModel(nn.Module):
     def __init__(self):
         super().__init__()
@@ -21,8 +40,7 @@ class LandlordLstmModel(nn.Module):
         self.dense6 = nn.Linear(512, 1)
 
     def forward(self, z, x, return_value=False, flags=None):
-        lstm_out, (h_n, _) = self.lstm(z)
-        lstm_out = lstm_out[:,-1,:]
+        lstm_out = _lstm_history(self.lstm, z, x.shape[0])
         x = torch.cat([lstm_out,x], dim=-1)
         x = self.dense1(x)
         x = torch.relu(x)
@@ -56,8 +74,7 @@ class FarmerLstmModel(nn.Module):
         self.dense6 = nn.Linear(512, 1)
 
     def forward(self, z, x, return_value=False, flags=None):
-        lstm_out, (h_n, _) = self.lstm(z)
-        lstm_out = lstm_out[:,-1,:]
+        lstm_out = _lstm_history(self.lstm, z, x.shape[0])
         x = torch.cat([lstm_out,x], dim=-1)
         x = self.dense1(x)
         x = torch.relu(x)
@@ -79,6 +96,25 @@ class FarmerLstmModel(nn.Module):
                 action = torch.argmax(x,dim=0)[0]
             return dict(action=action)
 
+def factorized_conv1(conv, z, lengths=None):
+    """
+    conv(z) for a batch of legal actions where only row 0 (the
+    action) differs between the actions of a decision. The batch
+    holds consecutive decisions of `lengths` actions (default: a
+    single decision). conv is linear, so the rows shared by a
+    decision are convolved once and the one-row convolution of
+    every action is added on top.
+    """
+    if lengths is None:
+        lengths = [z.shape[0]]
+    starts = np.cumsum([0] + list(lengths[:-1]))
+    shared = F.conv1d(z[starts, 1:], conv.weight[:, 1:], None,
+                      conv.stride, conv.padding)
+    out = F.conv1d(z[:, :1], conv.weight[:, :1], conv.bias,
+                   conv.stride, conv.padding)
+    out += shared.repeat_interleave(torch.as_tensor(lengths, device=z.device), dim=0)
+    return out
+
 # 用于ResNet18和34的残差块，用的是2个3x3的卷积
 class BasicBlock(nn.Module):
     expansion = 1
@@ -137,6 +173,17 @@ class GeneralModel(nn.Module):
 
     def forward(self, z, x, return_value=False, flags=None, debug=False):
         out = F.relu(self.bn1(self.conv1(z)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def forward_factorized(self, z, x, lengths=None, return_value=False, flags=None):
+        """
+        Inference-only forward computing conv1 of the state rows
+        once per decision, see `factorized_conv1`.
+        """
+        out = F.relu(self.bn1(factorized_conv1(self.conv1, z, lengths)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def _forward_from_conv1(self, out, x, return_value, flags):
         out = self.layer1(out)
         out = self.layer2(out)
         out = self.layer3(out)
@@ -222,6 +269,17 @@ class MingpaiModel(nn.Module):
 
     def forward(self, z, x, return_value=False, flags=None, debug=False):
         out = F.relu(self.bn1(self.conv1(z)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def forward_factorized(self, z, x, lengths=None, return_value=False, flags=None):
+        """
+        Inference-only forward computing conv1 of the state rows
+        once per decision, see `factorized_conv1`.
+        """
+        out = F.relu(self.bn1(factorized_conv1(self.conv1, z, lengths)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def _forward_from_conv1(self, out, x, return_value, flags):
         out = self.layer1(out)
         out = self.layer2(out)
         out = self.layer3(out)
@@ -240,6 +298,52 @@ class MingpaiModel(nn.Module):
                 action = torch.argmax(out,dim=0)[0]
             return dict(action=action, max_value=torch.max(out))
 
+class StudentModel(nn.Module):
+    def __init__(self, z_rows=40, use_x=True, channels=32, hidden=256):
+        """
+        A compact actor model distilled from a GeneralModel
+        (z_rows=40, use_x=True) or a MingpaiModel (z_rows=37,
+        use_x=False): two residual blocks instead of six and a
+        three-layer MLP.
+        """
+        super().__init__()
+        self.config = dict(z_rows=z_rows, use_x=use_x, channels=channels, hidden=hidden)
+        self.use_x = use_x
+        self.conv1 = nn.Conv1d(z_rows, channels, kernel_size=(3,),
+                               stride=(2,), padding=1, bias=False) #1*27*channels
+        self.bn1 = nn.BatchNorm1d(channels)
+        self.layer1 = BasicBlock(channels, channels, stride=2) #1*14*channels
+        self.layer2 = BasicBlock(channels, channels * 2, stride=2) #1*7*(2*channels)
+        self.linear1 = nn.Linear(channels * 2 * 7 + (15 * 4 if use_x else 0), hidden)
+        self.linear2 = nn.Linear(hidden, hidden // 2)
+        self.linear3 = nn.Linear(hidden // 2, 1)
+
+    def forward(self, z, x, return_value=False, flags=None, debug=False):
+        out = F.relu(self.bn1(self.conv1(z)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def forward_factorized(self, z, x, lengths=None, return_value=False, flags=None):
+        out = F.relu(self.bn1(factorized_conv1(self.conv1, z, lengths)))
+        return self._forward_from_conv1(out, x, return_value, flags)
+
+    def _forward_from_conv1(self, out, x, return_value, flags):
+        out = self.layer1(out)
+        out = self.layer2(out)
+        out = out.flatten(1,2)
+        if self.use_x:
+            out = torch.cat([x,x,x,x,out], dim=-1)
+        out = F.leaky_relu_(self.linear1(out))
+        out = F.leaky_relu_(self.linear2(out))
+        out = self.linear3(out)
+        if return_value:
+            return dict(values=out)
+        else:
+            if flags is not None and flags.exp_epsilon > 0 and np.random.rand() < flags.exp_epsilon:
+                action = torch.randint(out.shape[0], (1,))[0]
+            else:
+                action = torch.argmax(out,dim=0)[0]
+            return dict(action=action, max_value=torch.max(out))
+
 
 # Model dict is only used in evaluation but not training
 model_dict = {}
@@ -252,6 +356,95 @@ model_dict_new['landlord_up'] = GeneralModel
 model_dict_new['landlord_down'] = GeneralModel
 model_dict_new['bidding'] = BidModel
 
+# Architecture name -> model class and the shapes of one sample of
+# its inputs (None if unused). `z_shared` models take a single z for
+# all the legal actions of a decision.
+MODEL_REGISTRY = OrderedDict([
+    ('lstm_landlord', dict(cls=LandlordLstmModel, z_shape=(5, 162), x_shape=(373,), z_shared=True)),
+    ('lstm_farmer', dict(cls=FarmerLstmModel, z_shape=(5, 162), x_shape=(484,), z_shared=True)),
+    ('general', dict(cls=GeneralModel, z_shape=(40, 54), x_shape=(15,), z_shared=False)),
+    ('mingpai', dict(cls=MingpaiModel, z_shape=(37, 54), x_shape=None, z_shared=False)),
+    ('bid', dict(cls=BidModel, z_shape=None, x_shape=(114,), z_shared=False)),
+    ('student', dict(cls=StudentModel, z_shape=None, x_shape=None, z_shared=False)),
+])
+
+
+def build_model(arch, device="cpu", **kwargs):
+    """
+    A new model of the registered architecture `arch`.
+    """
+    if arch not in MODEL_REGISTRY:
+        raise ValueError('Unknown model architecture: %s' % arch)
+    if not device == "cpu":
+        device = 'cuda:' + str(device)
+    return MODEL_REGISTRY[arch]['cls'](**kwargs).to(torch.device(device))
+
+
+def detect_arch(state_dict):
+    """
+    The registered architecture a state dict was saved from.
+    """
+    if 'lstm.weight_ih_l0' in state_dict:
+        return 'lstm_landlord' if state_dict['dense1.weight'].shape[1] == 373 + 128 else 'lstm_farmer'
+    if 'conv1.weight' in state_dict:
+        if 'layer3.0.conv1.weight' not in state_dict:
+            return 'student'
+        return 'general' if state_dict['conv1.weight'].shape[1] == 40 else 'mingpai'
+    if 'dense1.weight' in state_dict and state_dict['dense1.weight'].shape[1] == 114:
+        return 'bid'
+    raise ValueError('Unknown model architecture')
+
+
+# Content hash -> state dict, and (path, mtime, size) -> content hash
+_weights_cache = {}
+_weights_hashes = {}
+
+
+def load_weights(path):
+    """
+    The CPU state dict saved at `path`. Files with the same content
+    are deserialized once per process, an unchanged file is not
+    read again.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    digest = _weights_hashes.get(key)
+    if digest is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in _weights_cache:
+            _weights_cache[digest] = torch.load(io.BytesIO(data), map_location="cpu")
+        _weights_hashes[key] = digest
+    return _weights_cache[digest]
+
+
+def state_dict_hash(state_dict):
+    """
+    SHA-1 of the names and values of `state_dict`, the same for equal
+    weights on any device.
+    """
+    digest = hashlib.sha1()
+    for name, value in state_dict.items():
+        digest.update(name.encode())
+        digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def load_model(path, arch=None, device="cpu"):
+    """
+    An eval-mode model with the weights saved at `path`, of the
+    architecture detected from them unless `arch` is given. Weights
+    the architecture has no parameter for are ignored.
+    """
+    pretrained = load_weights(path)
+    arch = arch or detect_arch(pretrained)
+    model = build_model(arch, device)
+    model_state_dict = model.state_dict()
+    model_state_dict.update({k: v for k, v in pretrained.items() if k in model_state_dict})
+    model.load_state_dict(model_state_dict)
+    return model.eval()
+
 
 class OldModel:
     """
@@ -333,32 +526,93 @@ class Model:
 
 class MingpaiModels:
     def __init__(self, device=0):
-        self.models = {}
+        """
+        The three models, kept in two weight slots. Actors read the
+        active slot while new weights are loaded into the staged one
+        with `load_state_dict`; `bump_version` then makes the staged
+        slot active, so a forward never sees half-loaded weights.
+        """
         if not device == "cpu":
             device = 'cuda:' + str(device)
-        self.models['landlord'] = GeneralModel().to(torch.device(device))
-        self.models['landlord_up'] = MingpaiModel().to(torch.device(device))
-        self.models['landlord_down'] = MingpaiModel().to(torch.device(device))
+        self.slots = []
+        for _ in range(2):
+            slot = {}
+            slot['landlord'] = GeneralModel().to(torch.device(device))
+            slot['landlord_up'] = MingpaiModel().to(torch.device(device))
+            slot['landlord_down'] = MingpaiModel().to(torch.device(device))
+            self.slots.append(slot)
+        # Bumped every time new weights are published. Its parity is
+        # the active slot, and actors holding exported copies use it
+        # to know when to reload
+        self.version = torch.zeros(1, dtype=torch.int64)
+
+    @property
+    def models(self):
+        return self.slots[self.get_version() % 2]
 
     def forward(self, position, z, x, training=False, flags=None, debug=False):
         model = self.models[position]
         return model.forward(z, x, training, flags, debug)
 
+    def forward_factorized(self, position, z, x, lengths=None, training=False, flags=None):
+        model = self.models[position]
+        return model.forward_factorized(z, x, lengths, training, flags)
+
     def share_memory(self):
-        self.models['landlord'].share_memory()
-        self.models['landlord_up'].share_memory()
-        self.models['landlord_down'].share_memory()
+        for slot in self.slots:
+            slot['landlord'].share_memory()
+            slot['landlord_up'].share_memory()
+            slot['landlord_down'].share_memory()
+        self.version.share_memory_()
 
     def eval(self):
-        self.models['landlord'].eval()
-        self.models['landlord_up'].eval()
-        self.models['landlord_down'].eval()
+        for slot in self.slots:
+            slot['landlord'].eval()
+            slot['landlord_up'].eval()
+            slot['landlord_down'].eval()
+
+    def to(self, device):
+        """
+        Check that both slots are on `device`. The slots are shared
+        with the process that loads new weights; a copy on another
+        device would keep the weights it was made with, so moving
+        them is refused. Build the models on the actor device.
+        """
+        device = torch.device(device)
+        for slot in self.slots:
+            for model in slot.values():
+                current = next(model.parameters()).device
+                if current.type != device.type or (device.index is not None and current.index != device.index):
+                    raise ValueError('MingpaiModels on %s can not be moved to %s, the weight slots are '
+                                     'shared' % (current, device))
+        return self
 
     def parameters(self, position):
         return self.models[position].parameters()
 
-    def get_model(self, position):
+    def get_model(self, position, staged=False):
+        """
+        The model of `position` in the active slot, or in the slot
+        the next weights are loaded into if `staged`.
+        """
+        if staged:
+            return self.slots[(self.get_version() + 1) % 2][position]
         return self.models[position]
 
     def get_models(self):
-        return self.models
\ No newline at end of file
+        return self.models
+
+    def load_state_dict(self, position, state_dict):
+        """
+        Load weights into the staged slot. They are used once
+        `bump_version` is called.
+        """
+        self.get_model(position, staged=True).load_state_dict(state_dict)
+
+    def get_version(self):
+        return int(self.version[0])
+
+    def bump_version(self):
+        # A single int64 store, actors switch slots at their next
+        # forward without taking a lock
+        self.version += 1
@@ -0,0 +1,14 @@
+"""
+Imported by the forkserver (see `PRELOAD_MODULES`) to load the bid
+and farmer nets of BidModel once, before any actor is forked, so
+that all actors share their weights instead of each loading them on
+its first deal.
+"""
+import BidModel
+
+try:
+    BidModel.load_models()
+except Exception as e:
+    # The forkserver stops on any error but an ImportError, the
+    # actors then load the nets themselves
+    print("预加载叫牌模型失败:", repr(e))
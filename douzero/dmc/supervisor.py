@@ -0,0 +1,191 @@
+"""
+Supervision of the actor processes. A dead actor is restarted
+after a backoff that doubles with every crash in a row, its crash
+reason is recorded, and the shared buffers it was holding are
+handed back to the free queues so that no position runs out of
+buffers. Dead inference workers are restarted the same way.
+"""
+import threading
+import time
+
+from .utils import act, log, get_rss
+from .inference import serve, release_reader
+
+POSITIONS = ['landlord', 'landlord_up', 'landlord_down']
+# An actor that ran for this long before crashing starts its
+# backoff from the beginning again
+STABLE_SECONDS = 60
+
+
+def create_held_buffers(ctx, num_actors):
+    """
+    Shared (num_actors, positions) ints holding the buffer index
+    each actor is currently writing, or -1.
+    """
+    held = ctx.RawArray('i', num_actors * len(POSITIONS))
+    for k in range(len(held)):
+        held[k] = -1
+    return held
+
+
+class ActorSupervisor:
+    def __init__(self, ctx, flags):
+        self.ctx = ctx
+        self.flags = flags
+        self.error_queue = ctx.SimpleQueue()
+        self.actors = {}
+        self.crashes = {}
+        self.reasons = {}
+        self.ready_times = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def add(self, device, i, free_queue, held, args):
+        """
+        Register and start actor `i` of `device`. `args` are the
+        arguments of `act` up to `stage_stats`.
+        """
+        if device not in self.ready_times:
+            self.ready_times[device] = self.ctx.RawArray('d', self.flags.num_actors)
+        self.actors[(device, i)] = dict(free_queue=free_queue, held=held, args=args,
+                                        process=None, started=0.0, restart_at=None,
+                                        backoff=0.0, reported=False)
+        self.crashes[(device, i)] = []
+        self._start(device, i)
+
+    def add_inference_worker(self, i, args):
+        """
+        Register and start inference worker `i`. `args` are the
+        arguments of `serve`.
+        """
+        self.workers[i] = dict(args=args, process=None, started=0.0, restart_at=None,
+                               backoff=0.0, crashes=0)
+        self._start_worker(i)
+
+    def _start_worker(self, i):
+        worker = self.workers[i]
+        worker['started'] = time.time()
+        process = self.ctx.Process(target=serve, args=worker['args'], daemon=True)
+        process.start()
+        worker['process'] = process
+        worker['restart_at'] = None
+
+    def _check_workers(self, now):
+        for i, worker in self.workers.items():
+            if worker['restart_at'] is not None:
+                if now >= worker['restart_at']:
+                    print("重启推理服务 %d" % i)
+                    release_reader(worker['args'][1])
+                    self._start_worker(i)
+                continue
+            process = worker['process']
+            if process.is_alive():
+                continue
+            process.join()
+            if process.exitcode == 0:
+                continue
+            worker['crashes'] += 1
+            if now - worker['started'] > STABLE_SECONDS:
+                worker['backoff'] = 0.0
+            worker['backoff'] = min(max(worker['backoff'] * 2, self.flags.actor_restart_backoff),
+                                    self.flags.actor_restart_max_backoff)
+            worker['restart_at'] = now + worker['backoff']
+            log.error('Inference worker %d died (%d crashes): exitcode %s; restarting in %.1f s',
+                      i, worker['crashes'], process.exitcode, worker['backoff'])
+
+    def _start(self, device, i):
+        actor = self.actors[(device, i)]
+        self.ready_times[device][i] = 0.0
+        actor['started'] = time.time()
+        process = self.ctx.Process(
+            target=act, args=actor['args'] + (actor['held'], self.error_queue, self.ready_times[device]))
+        process.start()
+        actor['process'] = process
+        actor['restart_at'] = None
+        actor['reported'] = False
+
+    def _report_startup(self, device, i):
+        """
+        Log how long the actor took from being started to dealing
+        its first games, and its resident memory at that point.
+        """
+        actor = self.actors[(device, i)]
+        ready = self.ready_times[device][i]
+        if actor['reported'] or ready == 0.0:
+            return
+        actor['reported'] = True
+        rss = get_rss(actor['process'].pid)
+        log.info('Actor %s-%d ready after %.1f s, RSS %s', str(device), i, ready - actor['started'],
+                 'unknown' if rss is None else '%.0f MB' % (rss / 2 ** 20))
+
+    def _read_reasons(self):
+        while not self.error_queue.empty():
+            device, i, reason = self.error_queue.get()
+            self.reasons[(device, i)] = reason
+
+    def _reclaim(self, device, i):
+        """
+        Hand the buffers a dead actor was writing back to the
+        free queues.
+        """
+        actor = self.actors[(device, i)]
+        reclaimed = 0
+        for k, position in enumerate(POSITIONS):
+            index = actor['held'][i * len(POSITIONS) + k]
+            if index >= 0:
+                actor['free_queue'][position].put(index)
+                actor['held'][i * len(POSITIONS) + k] = -1
+                reclaimed += 1
+        return reclaimed
+
+    def check(self):
+        """
+        Restart the actors and inference workers whose backoff is
+        over and schedule the restart of the ones that died since
+        the last check.
+        """
+        with self.lock:
+            now = time.time()
+            self._check_workers(now)
+            for (device, i), actor in self.actors.items():
+                if actor['restart_at'] is not None:
+                    if now >= actor['restart_at']:
+                        print("重启Actor %s-%d" % (str(device), i))
+                        self._start(device, i)
+                    continue
+                process = actor['process']
+                if process.is_alive():
+                    self._report_startup(device, i)
+                    continue
+                process.join()
+                if process.exitcode == 0:
+                    # Stopped by KeyboardInterrupt, not a crash
+                    continue
+                # The reason is sent before the actor exits
+                self._read_reasons()
+                reason = self.reasons.pop((device, i), 'exitcode %s' % process.exitcode)
+                self.crashes[(device, i)].append((now, reason))
+                reclaimed = self._reclaim(device, i)
+                if now - actor['started'] > STABLE_SECONDS:
+                    actor['backoff'] = 0.0
+                actor['backoff'] = min(max(actor['backoff'] * 2, self.flags.actor_restart_backoff),
+                                       self.flags.actor_restart_max_backoff)
+                actor['restart_at'] = now + actor['backoff']
+                log.error('Actor %s-%d died (%d crashes): %s; reclaimed %d buffers, restarting in %.1f s',
+                          str(device), i, len(self.crashes[(device, i)]), reason, reclaimed, actor['backoff'])
+
+    def crash_counts(self):
+        return {key: len(crashes) for key, crashes in self.crashes.items() if crashes}
+
+    def run(self, interval=1.0):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                print("在检查Actor状态时出现错误:", repr(e))
+            time.sleep(interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
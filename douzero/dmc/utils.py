@@ -4,13 +4,16 @@ import logging
 import traceback
 import numpy as np
 from collections import Counter
+import random
 import time
 
 import torch
 from torch import multiprocessing as mp
 
-from .env_utils import Environment
-from douzero.env import Env
+from .env_utils import VecEnvironment
+from .export import get_actor_model
+from douzero.env.client_env import ClientEnv
+from douzero.env.deal_pool import DealPool
 import douzero.env.move_detector as md
 from search_utility import search_actions, select_optimal_path, check_42, action_in_tree
 
@@ -39,28 +42,231 @@ log.addHandler(shandle)
 log.setLevel(logging.INFO)
 
 # Buffers are used to transfer data between actor processes
-# and learner processes. They are shared tensors in GPU
+# and learner processes. They are shared tensors in CPU memory
 Buffers = typing.Dict[str, typing.List[torch.Tensor]]
 
-def create_env(flags):
-    return Env(flags.objective)
+# Stages of the actor loop whose time is measured
+ACTOR_STAGES = ['legal_moves', 'encode', 'forward', 'trajectory', 'queue', 'reset']
 
-def get_batch(b_queues, position, flags, lock):
+
+# Modules the forkserver imports once so that forked actors
+# share them instead of importing them again; douzero.dmc.preload
+# also loads the bid model weights they share
+PRELOAD_MODULES = ['torch', 'numpy', 'BidModel', 'client_helper', 'search_utility', 'douzero.dmc.utils',
+                   'douzero.dmc.preload']
+
+
+def get_context(flags):
+    """
+    The multiprocessing context the actors are started with.
+    """
+    start_method = flags.start_method
+    if start_method not in mp.get_all_start_methods():
+        print("当前系统不支持 %s，改用 spawn 启动Actor" % start_method)
+        start_method = 'spawn'
+    ctx = mp.get_context(start_method)
+    if start_method == 'forkserver':
+        ctx.set_forkserver_preload(PRELOAD_MODULES)
+        # The forkserver can only hand a few file descriptors to a
+        # new process, so shared tensors are passed by file name
+        mp.set_sharing_strategy('file_system')
+    return ctx
+
+
+def get_rss(pid):
+    """
+    Resident memory of a process in bytes, or None where it
+    can not be read.
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def create_env(flags, deal_pool=None, timer=None):
+    return ClientEnv(flags.objective, deal_pool, timer)
+
+
+def create_stage_stats(ctx, num_actors):
+    """
+    Shared (num_actors, stages, 2) doubles holding the total
+    seconds and the number of calls of every stage of every
+    actor. Each actor only writes its own row.
+    """
+    return ctx.RawArray('d', num_actors * len(ACTOR_STAGES) * 2)
+
+
+def _stage_stats_array(stage_stats):
+    return np.frombuffer(stage_stats, dtype=np.float64).reshape(-1, len(ACTOR_STAGES), 2)
+
+
+class StageTimer:
+    def __init__(self, stage_stats, actor_id):
+        """
+        Accumulate the time of the actor stages into the row
+        of `actor_id` of the shared `stage_stats`. `lap` adds
+        the time since the last `start` or `lap` to a stage.
+        """
+        self.stats = _stage_stats_array(stage_stats)[actor_id]
+        self.index = {stage: k for k, stage in enumerate(ACTOR_STAGES)}
+        self.mark = time.perf_counter()
+
+    def start(self):
+        self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        k = self.index[stage]
+        self.stats[k, 0] += now - self.mark
+        self.stats[k, 1] += 1
+        self.mark = now
+
+
+def read_stage_stats(stage_stats):
+    """
+    A copy of the stage totals summed over the actors, as an
+    array of (seconds, calls) per stage.
+    """
+    return _stage_stats_array(stage_stats).sum(axis=0)
+
+
+def format_stage_stats(current, last):
+    """
+    Describe the stage time spent between two `read_stage_stats`
+    snapshots: the share of every stage and its mean time per call.
+    """
+    delta = current - last
+    total = delta[:, 0].sum()
+    if total <= 0:
+        return ''
+    parts = []
+    for k, stage in enumerate(ACTOR_STAGES):
+        seconds, calls = delta[k]
+        us = seconds / calls * 1e6 if calls > 0 else 0.0
+        parts.append('%s %.1f%% (%.0fus)' % (stage, seconds / total * 100, us))
+    return ', '.join(parts)
+
+class BatchCollector:
+    def __init__(self, free_queue, full_queue, buffers, flags):
+        """
+        The single consumer of the full queue of one position. The
+        unrolls named by the full queue are copied one by one into a
+        (T, B, ...) batch allocated up front, and every buffer is
+        freed as soon as it is copied.
+        """
+        self.free_queue = free_queue
+        self.full_queue = full_queue
+        self.buffers = buffers
+        self.batch_size = flags.batch_size
+        # Number of batches, seconds spent waiting for the first
+        # unroll of a batch and seconds to fill a whole batch
+        self.count = 0
+        self.wait_time = 0.0
+        self.fill_time = 0.0
+
+    def _allocate(self):
+        return {
+            key: torch.empty((bufs[0].shape[0], self.batch_size) + tuple(bufs[0].shape[1:]), dtype=bufs[0].dtype)
+            for key, bufs in self.buffers.items()
+        }
+
+    def get(self):
+        batch = self._allocate()
+        st = time.perf_counter()
+        first = None
+        b = 0
+        while b < self.batch_size:
+            indices = [self.full_queue.get()]
+            if first is None:
+                first = time.perf_counter()
+            # Take whatever else is already queued in the same pass
+            while b + len(indices) < self.batch_size and not self.full_queue.empty():
+                indices.append(self.full_queue.get())
+            for m in indices:
+                for key, bufs in self.buffers.items():
+                    batch[key][:, b] = bufs[m]
+                self.free_queue.put(m)
+                b += 1
+        self.count += 1
+        self.wait_time += first - st
+        self.fill_time += time.perf_counter() - st
+        return batch
+
+    def stats(self):
+        return self.count, self.wait_time, self.fill_time
+
+
+def format_fill_stats(current, last):
+    """
+    Describe the batches collected between two snapshots of
+    `BatchCollector.stats` of every position.
+    """
+    parts = []
+    for position in current:
+        count, wait_time, fill_time = [c - l for c, l in zip(current[position], last[position])]
+        if count > 0:
+            parts.append('%s %d (%.2fs/batch, wait %.2fs)' % (position, count, fill_time / count, wait_time / count))
+    return ', '.join(parts)
+
+
+def get_obs_shapes(flags):
+    """
+    The shapes of obs_z (including the action row) and
+    obs_x_batch of one frame for every position, read from
+    a game played with random moves.
+    """
+    env = create_env(flags)
+    obs = env.reset(None, 'cpu')
+    shapes = {}
+    while len(shapes) < 3:
+        shapes[obs['position']] = ((obs['z'].shape[0] + 1,) + obs['z'].shape[1:],
+                                   obs['x_no_action'].shape)
+        obs, _, done, _ = env.step(random.choice(obs['legal_actions']))
+        if done:
+            obs = env.reset(None, 'cpu')
+    return shapes
+
+
+def create_buffers(flags, device_iterator):
     """
-    This function will sample a batch from the buffers based
-    on the indices received from the full queue. It will also
-    free the indices by sending it to full_queue.
+    We create buffers for different positions as well as
+    for different devices (i.e., GPU). That is, each device
+    will have three buffers for the three positions. The
+    observations are stored as int8 since they only hold
+    -1, 0 and 1; this is also how they are uploaded.
     """
-    b_queue = b_queues[position]
-    buffer = []
-    while len(buffer) < flags.batch_size:
-        buffer.append(b_queue.get())
-    batch = {
-        key: torch.stack([m[key] for m in buffer], dim=1)
-        for key in ["done", "episode_return", "target", "obs_z", "obs_x_batch", "obs_type"]
-    }
-    del buffer
-    return batch
+    T = flags.unroll_length
+    positions = ['landlord', 'landlord_up', 'landlord_down']
+    obs_shapes = get_obs_shapes(flags)
+    buffers = {}
+    for device in device_iterator:
+        buffers[device] = {}
+        for position in positions:
+            z_shape, x_shape = obs_shapes[position]
+            specs = dict(
+                done=dict(size=(T,), dtype=torch.bool),
+                episode_return=dict(size=(T,), dtype=torch.float32),
+                target=dict(size=(T,), dtype=torch.float32),
+                obs_z=dict(size=(T,) + z_shape, dtype=torch.int8),
+                obs_x_batch=dict(size=(T,) + x_shape, dtype=torch.int8),
+                obs_type=dict(size=(T,), dtype=torch.int64),
+            )
+            _buffers: Buffers = {key: [] for key in specs}
+            for _ in range(flags.num_buffers):
+                for key in _buffers:
+                    _buffer = torch.empty(**specs[key]).share_memory_()
+                    _buffers[key].append(_buffer)
+            buffers[device][position] = _buffers
+    return buffers
 
 def create_optimizers(flags, learner_model):
     """
@@ -98,73 +304,202 @@ def path_to_str(path):
     return pstr
 
 
-def act(i, device, batch_queues, model, flags):
+class EpisodeBuffer:
+    """
+    Preallocated frames of one position in the running game of
+    one env. The tensors are allocated from the first frame and
+    grow if a game is longer than the capacity.
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.size = 0
+        self.buffers = None
+
+    def append(self, action, obs_z, obs_x_batch, obs_type):
+        if self.buffers is None:
+            self.buffers = {
+                "obs_z": torch.empty((self.capacity, obs_z.shape[0] + 1, obs_z.shape[1]), dtype=torch.int8),
+                "obs_x_batch": torch.empty((self.capacity,) + tuple(obs_x_batch.shape), dtype=torch.int8),
+                "obs_type": torch.empty(self.capacity, dtype=torch.int64),
+            }
+        elif self.size == self.capacity:
+            self.capacity *= 2
+            for key, buf in self.buffers.items():
+                grown = torch.empty((self.capacity,) + tuple(buf.shape[1:]), dtype=buf.dtype)
+                grown[:self.size] = buf
+                self.buffers[key] = grown
+        n = self.size
+        self.buffers["obs_z"][n, 0] = _cards2tensor(action)
+        self.buffers["obs_z"][n, 1:] = obs_z
+        self.buffers["obs_x_batch"][n] = obs_x_batch
+        self.buffers["obs_type"][n] = obs_type
+        self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+
+class TrajectoryBuffer:
+    """
+    Fixed-capacity ring of finished frames of one position. Whole
+    games are written in place with their done, episode_return and
+    target, and full unrolls are read back as contiguous slices:
+    the capacity is a multiple of the unroll length and reads
+    always start at a multiple of it, so an unroll never wraps.
+    """
+    def __init__(self, unroll_length, num_unrolls=4):
+        self.T = unroll_length
+        self.capacity = unroll_length * num_unrolls
+        self.head = 0
+        self.tail = 0
+        self.buffers = None
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def _allocate(self, episode):
+        self.buffers = {
+            "done": torch.empty(self.capacity, dtype=torch.bool),
+            "episode_return": torch.empty(self.capacity, dtype=torch.float32),
+            "target": torch.empty(self.capacity, dtype=torch.float32),
+        }
+        for key, buf in episode.buffers.items():
+            self.buffers[key] = torch.empty((self.capacity,) + tuple(buf.shape[1:]), dtype=buf.dtype)
+
+    def _grow(self):
+        size = len(self)
+        order = (self.tail + torch.arange(size)) % self.capacity
+        self.capacity *= 2
+        for key, buf in self.buffers.items():
+            grown = torch.empty((self.capacity,) + tuple(buf.shape[1:]), dtype=buf.dtype)
+            grown[:size] = buf[order]
+            self.buffers[key] = grown
+        self.head, self.tail = size, 0
+
+    def add_episode(self, episode, episode_return):
+        """
+        Write the frames of a finished game.
+        """
+        n = episode.size
+        if self.buffers is None:
+            self._allocate(episode)
+        while len(self) + n > self.capacity:
+            self._grow()
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        for key, buf in episode.buffers.items():
+            self.buffers[key][start:start + first] = buf[:first]
+            self.buffers[key][:n - first] = buf[first:n]
+        index = (start + torch.arange(n)) % self.capacity
+        self.buffers["done"][index] = False
+        self.buffers["done"][index[-1]] = True
+        self.buffers["episode_return"][index] = 0.0
+        self.buffers["episode_return"][index[-1]] = episode_return
+        self.buffers["target"][index] = episode_return
+        self.head += n
+
+    def pop_unroll(self):
+        """
+        Return the oldest full unroll as views into the ring, or None.
+        The views stay valid until the next call to `add_episode`.
+        """
+        if len(self) < self.T:
+            return None
+        start = self.tail % self.capacity
+        self.tail += self.T
+        return {key: buf[start:start + self.T] for key, buf in self.buffers.items()}
+
+
+def act(i, device, free_queue, full_queue, model, buffers, flags, inference=None, stage_stats=None,
+        held_buffers=None, error_queue=None, ready_times=None):
+    """
+    Actor loop. If `held_buffers` is given, the buffer index being
+    written for every position is kept in the row of this actor so
+    that a supervisor can free it if the actor dies; the reason of
+    a crash and the number of frames lost with it are put on
+    `error_queue`. The time the first games are dealt is written
+    to `ready_times[i]`.
+    """
     positions = ['landlord', 'landlord_up', 'landlord_down']
-    for pos in positions:
-        model.models[pos].to(torch.device(device if device == "cpu" else ("cuda:"+str(device))))
+    trajectory_bufs, episode_bufs = {}, []
     try:
+        model.to(torch.device(device if device == "cpu" else ("cuda:"+str(device))))
+        model = get_actor_model(model, flags, device)
         T = flags.unroll_length
+        if flags.actor_threads > 0:
+            torch.set_num_threads(flags.actor_threads)
+        if flags.actor_affinity and hasattr(os, 'sched_setaffinity'):
+            # Pin the actor to its own block of actor_threads cores
+            cpus = sorted(os.sched_getaffinity(0))
+            n = max(flags.actor_threads, 1)
+            os.sched_setaffinity(0, [cpus[(i * n + k) % len(cpus)] for k in range(n)])
+        if flags.start_method != 'spawn':
+            # Forked actors inherit the random state of the forkserver
+            seed = int.from_bytes(os.urandom(4), 'little')
+            np.random.seed(seed)
+            torch.manual_seed(seed)
         log.info('Device %s Actor %i started.', str(device), i)
 
-        env = create_env(flags)
-        env = Environment(env, device)
+        timer = None
+        if stage_stats is not None:
+            timer = StageTimer(stage_stats, i)
+        deal_pool = None
+        if flags.deal_pool_size > 0:
+            deal_pool = DealPool(flags.deal_pool_size, flags.deal_batch_size)
+        envs = VecEnvironment([create_env(flags, deal_pool, timer) for _ in range(flags.num_envs)], device, inference)
 
-        done_buf = {p: [] for p in positions}
-        episode_return_buf = {p: [] for p in positions}
-        target_buf = {p: [] for p in positions}
-        obs_z_buf = {p: [] for p in positions}
-        size = {p: 0 for p in positions}
-        type_buf = {p: [] for p in positions}
-        obs_x_batch_buf = {p: [] for p in positions}
+        trajectory_bufs = {p: TrajectoryBuffer(T) for p in positions}
+        # Frames of the running game of every env, moved to the
+        # trajectory buffers once the game is finished
+        episode_bufs = [{p: EpisodeBuffer() for p in positions} for _ in range(len(envs))]
 
         position_index = {"landlord": 31, "landlord_up": 32, "landlord_down": 33}
-        position, obs, env_output = env.initial(model, device, flags=flags)
+        env_positions, _, env_outputs = envs.initial(model, device, flags=flags)
+        if ready_times is not None:
+            ready_times[i] = time.time()
         while True:
-            while True:
-                if len(obs['legal_actions']) > 1:
-                    with torch.no_grad():
-                        agent_output = model.forward(position, obs['z_batch'], obs['x_batch'], flags=flags)
-                    _action_idx = int(agent_output['action'].cpu().detach().numpy())
-                    action = obs['legal_actions'][_action_idx]
-                else:
-                    action = obs['legal_actions'][0]
-                obs_z_buf[position].append(torch.vstack((_cards2tensor(action).unsqueeze(0), env_output['obs_z'])).float())
-                x_batch = env_output['obs_x_no_action'].float()
-                obs_x_batch_buf[position].append(x_batch)
-                type_buf[position].append(position_index[position])
-                position, obs, env_output = env.step(action, model, device, flags=flags)
-                size[position] += 1
-                if env_output['done']:
-                    for p in positions:
-                        diff = size[p] - len(target_buf[p])
-                        # print(p, diff)
-                        if diff > 0:
-                            done_buf[p].extend([False for _ in range(diff-1)])
-                            done_buf[p].append(True)
-                            if p != "bidding":
-                                episode_return = env_output['episode_return']["play"][p] if p == 'landlord' else -env_output['episode_return']["play"][p]
-                                episode_return_buf[p].extend([0.0 for _ in range(diff-1)])
-                                episode_return_buf[p].append(episode_return)
-                                target_buf[p].extend([episode_return for _ in range(diff)])
-                    break
-            for p in positions:
-                if size[p] > T:
-                    # print(p, "epr", torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in episode_return_buf[p][:T]]),)
-                    batch_queues[p].put({
-                        "done": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in done_buf[p][:T]]),
-                        "episode_return": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in episode_return_buf[p][:T]]),
-                        "target": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in target_buf[p][:T]]),
-                        "obs_z": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in obs_z_buf[p][:T]]),
-                        "obs_x_batch": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in obs_x_batch_buf[p][:T]]),
-                        "obs_type": torch.stack([torch.tensor(ndarr, device="cpu") for ndarr in type_buf[p][:T]])
-                    })
-                    done_buf[p] = done_buf[p][T:]
-                    episode_return_buf[p] = episode_return_buf[p][T:]
-                    target_buf[p] = target_buf[p][T:]
-                    obs_x_batch_buf[p] = obs_x_batch_buf[p][T:]
-                    obs_z_buf[p] = obs_z_buf[p][T:]
-                    type_buf[p] = type_buf[p][T:]
-                    size[p] -= T
+            if timer is not None:
+                timer.start()
+            actions = envs.select_actions(model, flags=flags)
+            if timer is not None:
+                timer.lap('forward')
+            for k, action in enumerate(actions):
+                position, env_output = env_positions[k], env_outputs[k]
+                episode_bufs[k][position].append(action, env_output['obs_z'],
+                                                 env_output['obs_x_no_action'],
+                                                 position_index[position])
+            if timer is not None:
+                timer.lap('trajectory')
+            env_positions, _, env_outputs = envs.step(actions, model, device, flags=flags)
+            if timer is not None:
+                timer.start()
+            for k, env_output in enumerate(env_outputs):
+                if not env_output['done']:
+                    continue
+                for p in positions:
+                    episode_buf = episode_bufs[k][p]
+                    if episode_buf.size > 0:
+                        episode_return = env_output['episode_return']["play"][p] if p == 'landlord' else -env_output['episode_return']["play"][p]
+                        trajectory_bufs[p].add_episode(episode_buf, episode_return)
+                        episode_buf.clear()
+            for k, p in enumerate(positions):
+                unroll = trajectory_bufs[p].pop_unroll()
+                while unroll is not None:
+                    if timer is not None:
+                        timer.lap('trajectory')
+                    index = free_queue[p].get()
+                    if held_buffers is not None:
+                        held_buffers[i * len(positions) + k] = index
+                    for key in unroll:
+                        buffers[p][key][index][...] = unroll[key]
+                    if held_buffers is not None:
+                        held_buffers[i * len(positions) + k] = -1
+                    full_queue[p].put(index)
+                    if timer is not None:
+                        timer.lap('queue')
+                    unroll = trajectory_bufs[p].pop_unroll()
+            if timer is not None:
+                timer.lap('trajectory')
 
     except KeyboardInterrupt:
         pass
@@ -172,6 +507,10 @@ def act(i, device, batch_queues, model, flags):
         log.error('Exception in worker process %i', i)
         traceback.print_exc()
         print()
+        if error_queue is not None:
+            lost = sum(len(buf) for buf in trajectory_bufs.values()) + \
+                sum(buf.size for bufs in episode_bufs for buf in bufs.values())
+            error_queue.put((device, i, '%s, %d frames lost' % (repr(e), lost)))
         raise e
 
 
@@ -0,0 +1,137 @@
+"""
+Vectorized versions of the bid and multiply encoders of
+`douzero.env.env`, which encode the observations of N deals at once
+and give the same outputs, row by row, as the single-deal encoders.
+They live outside env.py because the server replaces that file.
+"""
+import numpy as np
+
+from douzero.env.features import Card2CountColumn, DeckCounts
+
+
+def _cards2counts_batch(hands):
+    """
+    Per-rank card counts of N hands at once. `hands` is an (N, k)
+    array, or a list of card lists of any length; shorter rows may
+    be padded with 0.
+    """
+    if not isinstance(hands, np.ndarray):
+        width = max([len(hand) for hand in hands] + [0])
+        padded = np.zeros((len(hands), width), dtype=np.int64)
+        for i, hand in enumerate(hands):
+            padded[i, :len(hand)] = hand
+        hands = padded
+    columns = Card2CountColumn[hands.astype(np.int64)]
+    columns += 16 * np.arange(len(hands))[:, np.newaxis]
+    counts = np.bincount(columns.ravel(), minlength=16 * len(hands))
+    return counts.reshape(len(hands), 16)[:, :15]
+
+
+def _counts2array_batch(counts):
+    """
+    Batch version of `_counts2array`: (N, 15) counts to (N, 54).
+    """
+    array = np.empty((len(counts), 54), dtype=np.int8)
+    array[:, :52] = (np.arange(4) < counts[:, :13, np.newaxis]).reshape(len(counts), 52)
+    array[:, 52:] = counts[:, 13:]
+    return array
+
+
+def gen_bid_legal_actions_batch(player_ids, bid_infos):
+    """
+    Batch version of `gen_bid_legal_actions` for N deals.
+    `player_ids` has shape (N,) and `bid_infos` (N, 4, 3).
+    Returns the (N, 2, 12) legal bid actions.
+    """
+    player_ids = np.asarray(player_ids)
+    bid_infos = np.asarray(bid_infos)
+    num_deals = len(bid_infos)
+    columns = (player_ids[:, np.newaxis] + np.array([-1, 0, 1])) % 3
+    self_bid_info = np.take_along_axis(
+        bid_infos, np.broadcast_to(columns[:, np.newaxis, :], bid_infos.shape), axis=2)
+    pending = (self_bid_info == -1).any(axis=2)
+    if not pending.any(axis=1).all():
+        raise ValueError('No pending bid round for deals %s' %
+                         np.nonzero(~pending.any(axis=1))[0].tolist())
+    curr_round = pending.argmax(axis=1)
+    bid_actions = np.repeat(self_bid_info[:, np.newaxis], 2, axis=1)
+    rows = np.arange(num_deals)
+    bid_actions[rows, 0, curr_round] = [0, 0, 0]
+    bid_actions[rows, 1, curr_round] = [0, 1, 0]
+    return bid_actions.reshape(num_deals, 2, 12)
+
+
+def _get_obs_for_bid_batch(player_ids, bid_infos, hands):
+    """
+    Batch version of `_get_obs_for_bid`. Every field of the
+    returned obs gets a leading dimension of size N.
+    """
+    my_handcards = _counts2array_batch(_cards2counts_batch(hands))
+    num_deals = len(my_handcards)
+
+    bid_legal_actions = gen_bid_legal_actions_batch(player_ids, bid_infos)
+    bid_info_batch = np.tile(bid_legal_actions, (1, 1, 5))
+
+    x_batch = np.empty((num_deals, 2, 54 + 60), dtype=np.float32)
+    x_batch[:, :, :54] = my_handcards[:, np.newaxis, :]
+    x_batch[:, :, 54:] = bid_info_batch
+    obs = {
+        'position': "",
+        'x_batch': x_batch,
+        'z_batch': np.zeros((num_deals, 2), dtype=np.int64),
+        'legal_actions': bid_legal_actions,
+        'x_no_action': my_handcards,
+        "bid_info_batch": bid_info_batch.astype(np.int8)
+    }
+    return obs
+
+
+# Layout of the multiply x_no_action: position, my hand cards,
+# other cards, three landlord cards, last action, three played
+# cards blocks, the three cards-left one-hots and the bomb one-hot.
+_MULTIPLY_MY_HAND = 3
+_MULTIPLY_OTHER = _MULTIPLY_MY_HAND + 54
+_MULTIPLY_THREE = _MULTIPLY_OTHER + 54
+_MULTIPLY_BOMB = _MULTIPLY_THREE + 54 * 5 + 20 + 17 + 17
+_MULTIPLY_NO_ACTION_SIZE = _MULTIPLY_BOMB + 15
+PositionIndex = {'landlord': 0, 'landlord_up': 1, 'landlord_down': 2}
+
+
+def _get_obs_for_multiply_batch(positions, bid_infos, hands, landlord_cards):
+    """
+    Batch version of `_get_obs_for_multiply`. `positions` is a list
+    of N positions, `bid_infos` has shape (N, 4, 3) and `hands` and
+    `landlord_cards` are (N, k) arrays or lists of card lists. Every
+    field of the returned obs gets a leading dimension of size N.
+    """
+    hand_counts = _cards2counts_batch(hands)
+    num_deals = len(hand_counts)
+    rows = np.arange(num_deals)
+
+    x_no_action = np.zeros((num_deals, _MULTIPLY_NO_ACTION_SIZE), dtype=np.int8)
+    x_no_action[rows, [PositionIndex[position] for position in positions]] = 1
+    x_no_action[:, _MULTIPLY_MY_HAND:_MULTIPLY_OTHER] = _counts2array_batch(hand_counts)
+    x_no_action[:, _MULTIPLY_OTHER:_MULTIPLY_THREE] = _counts2array_batch(DeckCounts - hand_counts)
+    x_no_action[:, _MULTIPLY_THREE:_MULTIPLY_THREE + 54] = \
+        _counts2array_batch(_cards2counts_batch(landlord_cards))
+    x_no_action[:, _MULTIPLY_BOMB] = 1
+
+    bid_info = np.asarray(bid_infos).reshape(num_deals, 12)
+    multiply_info_batch = np.eye(3, dtype=np.int64)
+
+    x_batch = np.zeros((num_deals, 3, _MULTIPLY_NO_ACTION_SIZE + 12 + 3 + 54), dtype=np.float32)
+    x_batch[:, :, :_MULTIPLY_NO_ACTION_SIZE] = x_no_action[:, np.newaxis, :]
+    x_batch[:, :, _MULTIPLY_NO_ACTION_SIZE:_MULTIPLY_NO_ACTION_SIZE + 12] = bid_info[:, np.newaxis, :]
+    x_batch[:, :, _MULTIPLY_NO_ACTION_SIZE + 12:_MULTIPLY_NO_ACTION_SIZE + 15] = multiply_info_batch
+
+    obs = {
+        'position': "",
+        'x_batch': x_batch,
+        'z_batch': np.full((num_deals, 3, 32, 54), -1, dtype=np.float32),
+        'legal_actions': np.tile(multiply_info_batch, (num_deals, 1, 1)),
+        'x_no_action': x_no_action,
+        'z': np.full((num_deals, 32, 54), -1, dtype=np.int8),
+        "bid_info": bid_info.astype(np.int8),
+        "multiply_info_batch": np.zeros((num_deals, 3), dtype=np.int8)
+    }
+    return obs
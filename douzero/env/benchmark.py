@@ -0,0 +1,293 @@
+"""
+Golden-output and timing harness for the observation encoders.
+Seeded self-play produces a fixed set of infosets (and bid/multiply
+inputs), the reference encoders of `douzero.env.env` turn them into
+golden observations, and the client encoders (or any replacement
+encoder) can then be checked for bit-exact equality and timed
+against the same inputs.
+"""
+import pickle
+import random
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+from douzero.env import env as env_module
+from douzero.env import batch_obs, features
+from douzero.env.env import Env
+
+# Bumped whenever the expected encoder outputs change. Version 2:
+# the legacy encoders return z_batch as one shared history, (1, T,
+# 162), instead of one copy per legal action.
+GOLDEN_VERSION = 2
+# Encoders whose golden z_batch is the first row of the one of
+# env.py, see GOLDEN_VERSION
+SHARED_HISTORY_ENCODERS = ['_get_obs_landlord', '_get_obs_landlord_up', '_get_obs_landlord_down']
+
+# Legal-action-count buckets used to group timing results
+BUCKETS = [(1, 1), (2, 5), (6, 20), (21, 50), (51, 100), (101, None)]
+
+# Encoder name -> positions whose infosets it is fed with
+INFOSET_ENCODERS = OrderedDict([
+    ('_get_obs_landlord', ['landlord']),
+    ('_get_obs_landlord_up', ['landlord_up']),
+    ('_get_obs_landlord_down', ['landlord_down']),
+    ('_get_obs_general', ['landlord']),
+    ('_get_obs_mingpai', ['landlord_up', 'landlord_down']),
+])
+BID_ENCODERS = ['_get_obs_for_bid', '_get_obs_for_bid_legacy']
+MULTIPLY_ENCODERS = ['_get_obs_for_multiply']
+ENCODERS = list(INFOSET_ENCODERS) + BID_ENCODERS + MULTIPLY_ENCODERS
+# Single-deal encoder -> batch encoder of `batch_obs` taking the
+# stacked arguments
+BATCH_ENCODERS = OrderedDict([
+    ('_get_obs_for_bid', '_get_obs_for_bid_batch'),
+    ('_get_obs_for_multiply', '_get_obs_for_multiply_batch'),
+])
+
+POSITIONS = ['landlord', 'landlord_up', 'landlord_down']
+
+
+# Modules the encoders are looked up in, client modules first
+ENCODER_MODULES = [features, batch_obs, env_module]
+
+
+def get_encoder(name):
+    """
+    Look up an encoder by name.
+    """
+    for module in ENCODER_MODULES:
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError('No encoder called %s' % name)
+
+
+def _encoder_args(name, infoset):
+    if name in ('_get_obs_general', '_get_obs_mingpai'):
+        return (infoset, infoset.player_position)
+    return (infoset,)
+
+
+def _random_bid_info(player_id):
+    """
+    A bid_info matrix with a random number of finished bid rounds
+    so that `player_id` still has a decision to make.
+    """
+    bid_info = np.full((4, 3), -1)
+    cols = [(player_id - 1) % 3, player_id, (player_id + 1) % 3]
+    for r in range(random.randint(0, 3)):
+        bid_info[r, cols] = [random.randint(0, 1) for _ in range(3)]
+    return bid_info
+
+
+def generate_cases(num_games=50, seed=0):
+    """
+    Play `num_games` seeded random games and collect the inputs of
+    every encoder. Returns a list of (encoder_name, args) tuples.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    env = Env('adp')
+    cases = []
+    for _ in range(num_games):
+        env.reset(None, 'cpu')
+        done = False
+        while not done:
+            infoset = env.infoset
+            for name, positions in INFOSET_ENCODERS.items():
+                if infoset.player_position in positions:
+                    cases.append((name, _encoder_args(name, infoset)))
+            _, _, done, _ = env.step(random.choice(infoset.legal_actions))
+
+        deck = env_module.deck.copy()
+        np.random.shuffle(deck)
+        player_id = random.randint(0, 2)
+        bid_info = _random_bid_info(player_id)
+        for name in BID_ENCODERS:
+            cases.append((name, (player_id, bid_info.copy(), sorted(deck[:17]))))
+        position = random.choice(POSITIONS)
+        num_cards = 20 if position == 'landlord' else 17
+        bid_info = np.array([[random.randint(0, 1) for _ in range(3)] for _ in range(4)])
+        for name in MULTIPLY_ENCODERS:
+            cases.append((name, (position, bid_info.copy(), sorted(deck[:num_cards]), sorted(deck[51:54]))))
+    return cases
+
+
+def _reference_obs(name, args):
+    obs = getattr(env_module, name)(*args)
+    if name in SHARED_HISTORY_ENCODERS:
+        obs['z_batch'] = obs['z_batch'][:1]
+    return obs
+
+
+def make_golden(cases):
+    """
+    Run the reference encoders of env.py on `cases` and attach
+    their outputs.
+    """
+    return {
+        'version': GOLDEN_VERSION,
+        'env_version': env_module.env_version,
+        'cases': [(name, args, _reference_obs(name, args)) for name, args in cases],
+    }
+
+
+def save_golden(path, num_games=50, seed=0):
+    golden = make_golden(generate_cases(num_games, seed))
+    with open(path, 'wb') as f:
+        pickle.dump(golden, f, pickle.HIGHEST_PROTOCOL)
+    return golden
+
+
+def load_golden(path):
+    with open(path, 'rb') as f:
+        golden = pickle.load(f)
+    if golden.get('version') != GOLDEN_VERSION:
+        raise ValueError('Golden file %s has version %s, expected %d; the encoder outputs '
+                         'have changed since it was saved, regenerate it with --save'
+                         % (path, golden.get('version'), GOLDEN_VERSION))
+    return golden
+
+
+def _same_value(expected, actual):
+    if isinstance(expected, np.ndarray) or isinstance(actual, np.ndarray):
+        if not (isinstance(expected, np.ndarray) and isinstance(actual, np.ndarray)):
+            return False
+        return expected.dtype == actual.dtype and \
+            expected.shape == actual.shape and \
+            np.array_equal(expected, actual)
+    return expected == actual
+
+
+def compare_obs(expected, actual):
+    """
+    Compare two observation dicts. Returns a list of the keys that
+    differ (missing, different dtype, shape or values).
+    """
+    mismatches = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in expected or key not in actual:
+            mismatches.append(key)
+        elif not _same_value(expected[key], actual[key]):
+            mismatches.append(key)
+    return mismatches
+
+
+def _bucket_of(n):
+    for low, high in BUCKETS:
+        if n >= low and (high is None or n <= high):
+            return _bucket_label(low, high)
+    return _bucket_label(*BUCKETS[0])
+
+
+def _bucket_label(low, high):
+    if high is None:
+        return '%d+' % low
+    if low == high:
+        return str(low)
+    return '%d-%d' % (low, high)
+
+
+def check_encoder(golden, name, encoder=None):
+    """
+    Run `encoder` (default: the current encoder called `name`) on
+    the golden inputs recorded for `name`. Returns the number of
+    cases checked and a list of (case_index, mismatched_keys).
+    """
+    encoder = encoder or get_encoder(name)
+    checked, failures = 0, []
+    for i, (case_name, args, expected) in enumerate(golden['cases']):
+        if case_name != name:
+            continue
+        checked += 1
+        mismatches = compare_obs(expected, encoder(*args))
+        if mismatches:
+            failures.append((i, mismatches))
+    return checked, failures
+
+
+def benchmark_encoder(golden, name, encoder=None, repeat=20):
+    """
+    Time `encoder` on the golden inputs recorded for `name`. Returns
+    a dict keyed by legal-action bucket with the number of cases,
+    mean microseconds per observation and mean peak bytes allocated
+    per observation.
+    """
+    encoder = encoder or get_encoder(name)
+    results = OrderedDict()
+    for case_name, args, expected in golden['cases']:
+        if case_name != name:
+            continue
+        bucket = _bucket_of(len(expected['legal_actions']))
+
+        st = time.perf_counter()
+        for _ in range(repeat):
+            encoder(*args)
+        us = (time.perf_counter() - st) / repeat * 1e6
+
+        tracemalloc.start()
+        encoder(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        record = results.setdefault(bucket, {'cases': 0, 'us': 0.0, 'bytes': 0.0})
+        record['cases'] += 1
+        record['us'] += us
+        record['bytes'] += peak
+    for record in results.values():
+        record['us'] /= record['cases']
+        record['bytes'] /= record['cases']
+    order = [_bucket_label(*b) for b in BUCKETS]
+    return OrderedDict(sorted(results.items(), key=lambda kv: order.index(kv[0])))
+
+
+def _stack_args(args_list):
+    """
+    Turn the per-deal arguments of a bid/multiply encoder into the
+    arguments of its batch version.
+    """
+    columns = list(zip(*args_list))
+    stacked = []
+    for column in columns:
+        if isinstance(column[0], np.ndarray):
+            stacked.append(np.stack(column))
+        else:
+            stacked.append(list(column))
+    return stacked
+
+
+def check_batch_encoder(golden, name, encoder=None):
+    """
+    Run the batch version of `name` once on all the golden inputs
+    of `name` and compare every slice with the golden output.
+    Returns the number of cases, a list of (case_index,
+    mismatched_keys) and the microseconds per deal.
+    """
+    encoder = encoder or get_encoder(BATCH_ENCODERS[name])
+    indices = [i for i, case in enumerate(golden['cases']) if case[0] == name]
+    if not indices:
+        return 0, [], 0.0
+    args = _stack_args([golden['cases'][i][1] for i in indices])
+    st = time.perf_counter()
+    obs = encoder(*args)
+    us = (time.perf_counter() - st) / len(indices) * 1e6
+    failures = []
+    for row, i in enumerate(indices):
+        actual = {key: value[row] if isinstance(value, np.ndarray) else value
+                  for key, value in obs.items()}
+        mismatches = compare_obs(golden['cases'][i][2], actual)
+        if mismatches:
+            failures.append((i, mismatches))
+    return len(indices), failures, us
+
+
+def format_report(name, checked, failures, timings):
+    lines = ['%s: %d cases, %s' % (name, checked, 'OK' if not failures else '%d MISMATCHES' % len(failures))]
+    for i, keys in failures[:5]:
+        lines.append('    case %d differs in %s' % (i, ', '.join(keys)))
+    for bucket, record in timings.items():
+        lines.append('    actions %-7s n=%-5d %9.1f us/obs %11.0f bytes/obs' % (
+            bucket, record['cases'], record['us'], record['bytes']))
+    return '\n'.join(lines)
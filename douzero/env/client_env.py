@@ -0,0 +1,127 @@
+"""
+The Env used by the training client. `douzero/env/env.py` is owned
+by the server and replaced by `update_env` whenever the server
+pushes a new version, so everything the client adds to the game
+loop lives in this subclass: dealing from a DealPool with the
+batched bid model, the per-stage timer and the FeatureCache
+shared by the three seats. Only the baseline interface of `Env`
+(the game engine, the dummy players and the reward helpers) is
+relied on. If env.py is not the version this module was checked
+against (see `features.CHECKED_ENV_VERSION`), the env behaves as
+`Env`.
+"""
+import random
+
+import numpy as np
+
+import BidModel
+from douzero.env.env import Env, deck
+from douzero.env.features import FeatureCache, get_obs, env_checked
+from douzero.env.deal_pool import assign_bid_seats
+
+
+class ClientEnv(Env):
+    def __init__(self, objective, deal_pool=None, timer=None):
+        """
+        Same as `Env`. If a DealPool is given, games that are
+        dealt with the bid model take their pre-scored deals from
+        it. If a timer is given, the time spent in resets, in
+        legal-move generation and in observation encoding is
+        added to its `reset`, `legal_moves` and `encode` stages.
+        """
+        super().__init__(objective)
+        self.deal_pool = deal_pool
+        self.timer = timer
+        self.checked = env_checked()
+
+        # Encoded features shared by the three seats, updated
+        # after every move
+        self.features = FeatureCache()
+
+    def reset(self, model, device, flags=None):
+        if not self.checked:
+            return super().reset(model, device, flags)
+        self._env.reset()
+
+        # Randomly shuffle the deck
+        if model is None:
+            _deck = deck.copy()
+            np.random.shuffle(_deck)
+            card_play_data = {'landlord': _deck[:20],
+                              'landlord_up': _deck[20:37],
+                              'landlord_down': _deck[37:54],
+                              'three_landlord_cards': _deck[17:20],
+                              }
+            for key in card_play_data:
+                card_play_data[key].sort()
+            self._env.card_play_init(card_play_data)
+            self.features.reset(card_play_data)
+            self.infoset = self._game_infoset
+            return get_obs(self.infoset, features=self.features)
+        else:
+            if self.timer is not None:
+                self.timer.start()
+            if self.deal_pool is not None:
+                card_play_data = self.deal_pool.get()
+            else:
+                card_play_data = deal_with_bid_model()
+            self._env.card_play_init(card_play_data)
+            self.features.reset(card_play_data)
+            self.infoset = self._game_infoset
+            obs = get_obs(self.infoset, features=self.features)
+            if self.timer is not None:
+                self.timer.lap('reset')
+            return obs, {
+                "bid_obs_buffer": None,
+                "multiply_obs_buffer": None
+            }, self.infoset
+
+    def step(self, action):
+        if not self.checked:
+            return super().step(action)
+        assert action in self.infoset.legal_actions
+        position = self._acting_player_position
+        self.players[position].set_action(action)
+        if self.timer is not None:
+            self.timer.start()
+        self._env.step()
+        self.infoset = self._game_infoset
+        if self.timer is not None:
+            self.timer.lap('legal_moves')
+        done = False
+        reward = 0.0
+        if self._game_over:
+            done = True
+            reward = {
+                "play": {
+                    "landlord": self._get_reward("landlord"),
+                    "landlord_up": self._get_reward("landlord_up"),
+                    "landlord_down": self._get_reward("landlord_down")
+                },
+                "bid": {
+                    "landlord": self._get_reward_bidding("landlord")*2,
+                    "landlord_up": self._get_reward_bidding("landlord_up"),
+                    "landlord_down": self._get_reward_bidding("landlord_down")
+                }
+            }
+            obs = None
+        else:
+            self.features.apply_move(position, action,
+                                     self._env.three_landlord_cards,
+                                     self._env.bomb_num)
+            obs = get_obs(self.infoset, features=self.features)
+            if self.timer is not None:
+                self.timer.lap('encode')
+        return obs, reward, done, {}
+
+
+def deal_with_bid_model():
+    """
+    Shuffle one deal, score its three hands with one bid-model
+    forward and seat them. Returns the `card_play_data` of the game.
+    """
+    _deck = deck.copy()
+    np.random.shuffle(_deck)
+    hands = [_deck[:17], _deck[17:34], _deck[34:51]]
+    scores = BidModel.predict_env_batch(hands)
+    return assign_bid_seats(hands, _deck[51:54], scores, random.random() > 0.5)
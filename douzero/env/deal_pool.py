@@ -0,0 +1,77 @@
+"""
+A background producer of pre-scored deals. Deals are shuffled
+and scored by the bid model in batches, seated the same way as
+in `ClientEnv.reset`, and handed out from a bounded queue so that
+dealing leaves the critical path of the actor.
+"""
+import queue
+import threading
+
+import numpy as np
+
+import BidModel
+from douzero.env.env import deck
+
+
+def assign_bid_seats(hands, three_landlord_cards, scores, swap_farmers):
+    """
+    Seat the three 17-card hands of a deal given their bid
+    scores and return the `card_play_data` of the game.
+    """
+    cards_ll, cards_llu, cards_lld = hands
+    score1, score2, score3 = scores
+    if score2 > score1:
+        cards_ll, cards_llu = cards_llu, cards_ll
+    if score3 > score1:
+        cards_ll, cards_lld = cards_ll, cards_lld
+    if swap_farmers:
+        cards_llu, cards_lld = cards_lld, cards_llu
+    cards_ll = cards_ll + three_landlord_cards
+    card_play_data = {'landlord': cards_ll,
+                      'landlord_up': cards_llu,
+                      'landlord_down': cards_lld,
+                      'three_landlord_cards': three_landlord_cards,
+                      }
+    for key in card_play_data:
+        card_play_data[key].sort()
+    return card_play_data
+
+
+def generate_deals(num_deals, rng=np.random):
+    """
+    Shuffle and score `num_deals` deals at once. Returns a list
+    of `card_play_data` dicts.
+    """
+    # Shuffle every row of an (N, 54) array of decks independently
+    order = np.argsort(rng.random_sample((num_deals, 54)), axis=1)
+    decks = np.asarray(deck)[order]
+    hands = decks[:, :51].reshape(num_deals, 3, 17)
+    scores = BidModel.predict_env_batch(hands)
+    swap_farmers = rng.random_sample(num_deals) > 0.5
+    return [assign_bid_seats(hands[i].tolist(), decks[i, 51:].tolist(),
+                             scores[i], swap_farmers[i])
+            for i in range(num_deals)]
+
+
+class DealPool:
+    def __init__(self, size=256, batch_size=64):
+        """
+        Start a daemon thread that keeps up to `size` deals
+        ready, generating them `batch_size` at a time.
+        """
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=size)
+        self.rng = np.random.RandomState()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        while True:
+            for card_play_data in generate_deals(self.batch_size, self.rng):
+                self.queue.put(card_play_data)
+
+    def get(self):
+        """
+        Take the next ready deal, waiting if the pool is empty.
+        """
+        return self.queue.get()
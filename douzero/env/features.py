@@ -0,0 +1,371 @@
+"""
+Incremental observation encoding for the general (ResNet) models.
+A FeatureCache keeps the feature blocks shared by the three seats
+and is updated after every move, so that encoding an observation
+only has to add the legal actions. The encoders give the same
+observations as `_get_obs_general` and `_get_obs_mingpai` of
+`douzero.env.env`, which stay untouched since the server replaces
+that file. The legacy encoders of the LSTM models give z_batch as
+one history shared by all the legal actions.
+"""
+import logging
+
+import numpy as np
+
+from douzero.env import env as env_module
+from douzero.env.env import Card2Column, _cards2array, _get_one_hot_bomb, _get_one_hot_array, \
+    _action_seq_list2array, _process_action_seq
+
+# Column of each card in the per-rank count vectors of FeatureCache.
+# Columns 13 and 14 count the small and the big joker, column 15
+# collects the 0 used to pad hands in the batch builders.
+Card2CountColumn = np.zeros(31, dtype=np.int64)
+for _card, _column in Card2Column.items():
+    Card2CountColumn[_card] = _column
+Card2CountColumn[20] = 13
+Card2CountColumn[30] = 14
+Card2CountColumn[0] = 15
+
+# Per-rank counts of a full deck
+DeckCounts = np.array([4] * 13 + [1, 1], dtype=np.int64)
+
+UpperPosition = {'landlord': 'landlord_up',
+                 'landlord_up': 'landlord_down',
+                 'landlord_down': 'landlord'}
+LowerPosition = {'landlord': 'landlord_down',
+                 'landlord_up': 'landlord',
+                 'landlord_down': 'landlord_up'}
+
+HISTORY_LENGTH = 32
+
+# The env_version of the env.py that the encoders of this module and
+# the game loop of ClientEnv were checked against (`python
+# benchmark.py obs`). Set it again once they pass with a new env.py.
+CHECKED_ENV_VERSION = "3.2.1"
+
+log = logging.getLogger('doudzero')
+_env_warned = False
+
+
+def env_checked():
+    """
+    Whether env.py is the version the client copies were checked
+    against. After the server pushes another env.py they may encode
+    an old layout, so callers fall back to env.py itself; this is
+    logged once per process.
+    """
+    global _env_warned
+    if env_module.env_version == CHECKED_ENV_VERSION:
+        return True
+    if not _env_warned:
+        log.warning('env.py is version %s but the client encoders were checked against %s, '
+                    'using the encoders and game loop of env.py',
+                    env_module.env_version, CHECKED_ENV_VERSION)
+        _env_warned = True
+    return False
+
+
+class FeatureCache(object):
+    """
+    Encoded feature blocks that are shared by all three seats:
+    hand cards and played cards per seat, the number of cards left,
+    the bomb count, the three landlord cards and the move history.
+    The env updates them incrementally after every move, so the
+    observation of the acting seat only has to encode its own
+    legal actions.
+    """
+
+    def __init__(self):
+        self.hand_counts = {}
+        self.hand_cards = {}
+        self.played_counts = {}
+        self.played_cards = {}
+        self.num_cards_left = None
+        self.three_landlord_cards = None
+        self.bomb_num = None
+        self.history = None
+        self._bomb_count = 0
+        self._num_moves = 0
+
+    def reset(self, card_play_data):
+        """
+        Encode the blocks at the start of a game.
+        """
+        for pos in ['landlord', 'landlord_up', 'landlord_down']:
+            self._set_hand(pos, _cards2counts(card_play_data[pos]))
+            self._set_played(pos, np.zeros(15, dtype=np.int64))
+        self._update_num_cards_left()
+        self.three_landlord_cards = _cards2array(card_play_data['three_landlord_cards'])
+        self._bomb_count = 0
+        self.bomb_num = _get_one_hot_bomb(0)
+        self.history = np.full((HISTORY_LENGTH, 54), -1, dtype=np.int8)
+        self._num_moves = 0
+
+    @classmethod
+    def from_infoset(cls, infoset):
+        """
+        Encode all the blocks from scratch from an infoset.
+        """
+        features = cls()
+        for pos in ['landlord', 'landlord_up', 'landlord_down']:
+            features._set_hand(pos, _cards2counts(infoset.all_handcards[pos]))
+            features._set_played(pos, _cards2counts(infoset.played_cards[pos]))
+        features._update_num_cards_left()
+        features.three_landlord_cards = _cards2array(infoset.three_landlord_cards)
+        features._bomb_count = infoset.bomb_num
+        features.bomb_num = _get_one_hot_bomb(infoset.bomb_num)
+        features.history = np.full((HISTORY_LENGTH, 54), -1, dtype=np.int8)
+        for _, action in infoset.card_play_action_seq[-HISTORY_LENGTH:]:
+            features._push_history(action)
+        features._num_moves = len(infoset.card_play_action_seq)
+        return features
+
+    def apply_move(self, position, action, three_landlord_cards, bomb_num):
+        """
+        Update the blocks after `position` played `action`. The
+        remaining three landlord cards and the bomb count are the
+        values of the game after the move.
+        """
+        if len(action) > 0:
+            counts = _cards2counts(action)
+            self._set_hand(position, self.hand_counts[position] - counts)
+            self._set_played(position, self.played_counts[position] + counts)
+            self._update_num_cards_left()
+            if position == 'landlord':
+                self.three_landlord_cards = _cards2array(three_landlord_cards)
+        if bomb_num != self._bomb_count:
+            self._bomb_count = bomb_num
+            self.bomb_num = _get_one_hot_bomb(bomb_num)
+        self._push_history(action)
+
+    def other_hand_cards(self, position):
+        """
+        The union of the hand cards of the two other seats.
+        """
+        counts = self.hand_counts[UpperPosition[position]] + \
+            self.hand_counts[LowerPosition[position]]
+        return _counts2array(counts)
+
+    def _set_hand(self, position, counts):
+        self.hand_counts[position] = counts
+        self.hand_cards[position] = _counts2array(counts)
+
+    def _set_played(self, position, counts):
+        self.played_counts[position] = counts
+        self.played_cards[position] = _counts2array(counts)
+
+    def _update_num_cards_left(self):
+        num_cards_left = np.zeros(54, dtype=np.int8)
+        for offset, pos in [(0, 'landlord'), (20, 'landlord_up'), (37, 'landlord_down')]:
+            num_cards = self.hand_counts[pos].sum()
+            if num_cards > 0:
+                num_cards_left[offset + num_cards - 1] = 1
+        self.num_cards_left = num_cards_left
+
+    def _push_history(self, action):
+        """
+        The history keeps the layout of `_action_seq_list2array`:
+        padding rows first, then the moves from the most recent
+        to the oldest.
+        """
+        if self._num_moves < HISTORY_LENGTH:
+            self.history[HISTORY_LENGTH - 1 - self._num_moves] = _cards2array(action)
+        else:
+            self.history[1:] = self.history[:-1]
+            self.history[0] = _cards2array(action)
+        self._num_moves += 1
+
+
+def get_obs(infoset, use_general=True, features=None):
+    """
+    Same as `douzero.env.env.get_obs`. `features` is the
+    FeatureCache of the env the infoset comes from; the general
+    encoders take the shared blocks from it instead of encoding
+    them again. The legacy encoders return z_batch as a batch of
+    one, (1, T, 162), since the history does not depend on the
+    action. If env.py is not the version these encoders were
+    checked against, its own `get_obs` is used.
+    """
+    if not env_checked():
+        return env_module.get_obs(infoset, use_general)
+    if use_general:
+        if infoset.player_position not in ["landlord", "landlord_up", "landlord_down"]:
+            raise ValueError('')
+        if infoset.player_position == "landlord":
+            return _get_obs_general(infoset, infoset.player_position, features)
+        else:
+            return _get_obs_mingpai(infoset, infoset.player_position, features)
+    if infoset.player_position == 'landlord':
+        return _get_obs_landlord(infoset)
+    elif infoset.player_position == 'landlord_up':
+        return _get_obs_landlord_up(infoset)
+    elif infoset.player_position == 'landlord_down':
+        return _get_obs_landlord_down(infoset)
+    else:
+        raise ValueError('')
+
+
+def _cards2counts(list_cards):
+    """
+    A utility function that counts the cards of each rank,
+    see `Card2CountColumn` for the column order.
+    """
+    return np.bincount(Card2CountColumn[np.asarray(list_cards, dtype=np.int64)],
+                       minlength=15)
+
+
+def _counts2array(counts):
+    """
+    Same encoding as `_cards2array`, but from the per-rank
+    card counts returned by `_cards2counts`.
+    """
+    array = np.empty(54, dtype=np.int8)
+    array[:52] = (np.arange(4) < counts[:13, np.newaxis]).ravel()
+    array[52:] = counts[13:]
+    return array
+
+
+def _get_obs_general(infoset, position, features=None):
+    """
+    Landlord features of the general model. The shared blocks are
+    taken from `features` (a FeatureCache kept by the env) when it is
+    given, otherwise they are encoded from the infoset.
+    """
+    if features is None:
+        features = FeatureCache.from_infoset(infoset)
+    num_legal_actions = len(infoset.legal_actions)
+
+    bid_info = np.array(infoset.bid_info).flatten()
+    multiply_info = np.array(infoset.multiply_info)
+    x_no_action = np.hstack((
+                             bid_info,  # 12
+                             multiply_info))  # 3
+    x_batch = np.repeat(x_no_action[np.newaxis, :],
+                        num_legal_actions, axis=0)
+
+    z = np.vstack((
+                  features.num_cards_left,  # 20 + 17 + 17
+                  features.hand_cards[position],  # 54
+                  features.other_hand_cards(position),  # 54
+                  features.three_landlord_cards,  # 54
+                  features.played_cards['landlord'],  # 54
+                  features.played_cards['landlord_up'],  # 54
+                  features.played_cards['landlord_down'],  # 54
+                  features.history  # 32 * 54
+                  ))
+    z_batch = _get_action_z_batch(infoset.legal_actions, z)
+    obs = {
+        'position': position,
+        'x_batch': x_batch.astype(np.float32),
+        'z_batch': z_batch,
+        'legal_actions': infoset.legal_actions,
+        'x_no_action': x_no_action.astype(np.int8),
+        'z': z,
+    }
+    return obs
+
+
+def _get_obs_mingpai(infoset, position, features=None):
+    """
+    Farmer features of the mingpai model, see `_get_obs_general`
+    for the meaning of `features`.
+    """
+    if features is None:
+        features = FeatureCache.from_infoset(infoset)
+
+    x_batch = np.array([0])
+
+    z = np.vstack((
+                  features.num_cards_left,  # 20 + 17 + 17
+                  features.hand_cards[position],  # 54
+                  features.hand_cards[UpperPosition[position]],  # 54
+                  features.hand_cards[LowerPosition[position]],  # 54
+                  features.history  # 32 * 54
+                  ))
+    z_batch = _get_action_z_batch(infoset.legal_actions, z)
+    obs = {
+        'position': position,
+        'x_batch': x_batch.astype(np.float32),
+        'z_batch': z_batch,
+        'x_no_action': np.array([0.1]),
+        'legal_actions': infoset.legal_actions,
+        'z': z,
+    }
+    return obs
+
+
+def _get_action_z_batch(legal_actions, z):
+    """
+    Stack the encoded legal actions on top of the shared `z` rows,
+    one sample per legal action.
+    """
+    z_batch = np.empty((len(legal_actions), len(z) + 1, 54), dtype=np.float32)
+    z_batch[:, 1:, :] = z
+    for j, action in enumerate(legal_actions):
+        z_batch[j, 0, :] = _cards2array(action)
+    return z_batch
+
+
+def _get_obs_landlord(infoset):
+    """
+    Same as `_get_obs_landlord` of env.py, but z_batch is the history
+    once, the LSTM models run it once and broadcast the result.
+    """
+    x_no_action = np.hstack((_cards2array(infoset.player_hand_cards),
+                             _cards2array(infoset.other_hand_cards),
+                             _cards2array(infoset.last_move),
+                             _cards2array(infoset.played_cards['landlord_up']),
+                             _cards2array(infoset.played_cards['landlord_down']),
+                             _get_one_hot_array(infoset.num_cards_left_dict['landlord_up'], 17),
+                             _get_one_hot_array(infoset.num_cards_left_dict['landlord_down'], 17),
+                             _get_one_hot_bomb(infoset.bomb_num)))
+    return _get_obs_legacy(infoset, 'landlord', x_no_action)
+
+
+def _get_obs_landlord_up(infoset):
+    return _get_obs_farmer(infoset, 'landlord_up', 'landlord_down')
+
+
+def _get_obs_landlord_down(infoset):
+    return _get_obs_farmer(infoset, 'landlord_down', 'landlord_up')
+
+
+def _get_obs_farmer(infoset, position, teammate):
+    """
+    Same as `_get_obs_landlord_up` and `_get_obs_landlord_down` of
+    env.py, see `_get_obs_landlord`.
+    """
+    x_no_action = np.hstack((_cards2array(infoset.player_hand_cards),
+                             _cards2array(infoset.other_hand_cards),
+                             _cards2array(infoset.played_cards['landlord']),
+                             _cards2array(infoset.played_cards[teammate]),
+                             _cards2array(infoset.last_move),
+                             _cards2array(infoset.last_move_dict['landlord']),
+                             _cards2array(infoset.last_move_dict[teammate]),
+                             _get_one_hot_array(infoset.num_cards_left_dict['landlord'], 20),
+                             _get_one_hot_array(infoset.num_cards_left_dict[teammate], 17),
+                             _get_one_hot_bomb(infoset.bomb_num)))
+    return _get_obs_legacy(infoset, position, x_no_action)
+
+
+def _get_obs_legacy(infoset, position, x_no_action):
+    """
+    The observation of a legacy encoder: x_batch is `x_no_action`
+    followed by the action, one row per legal action.
+    """
+    num_legal_actions = len(infoset.legal_actions)
+    x_batch = np.empty((num_legal_actions, len(x_no_action) + 54), dtype=np.float32)
+    x_batch[:, :len(x_no_action)] = x_no_action
+    for j, action in enumerate(infoset.legal_actions):
+        x_batch[j, len(x_no_action):] = _cards2array(action)
+    z = _action_seq_list2array(_process_action_seq(
+        infoset.card_play_action_seq, 15, False), False)
+    obs = {
+        'position': position,
+        'x_batch': x_batch,
+        'z_batch': z[np.newaxis, :, :].astype(np.float32),
+        'legal_actions': infoset.legal_actions,
+        'x_no_action': x_no_action.astype(np.int8),
+        'z': z.astype(np.int8),
+    }
+    return obs
@@ -1,34 +1,16 @@
 import torch
 import numpy as np
 
-from douzero.env.env import get_obs
-
-def _load_model(position, model_path, model_type):
-    from douzero.dmc.models import model_dict_new, model_dict
-    model = None
-    if model_type == "general":
-        model = model_dict_new[position]()
-    else:
-        model = model_dict[position]()
-    model_state_dict = model.state_dict()
-    if torch.cuda.is_available():
-        pretrained = torch.load(model_path, map_location='cuda:0')
-    else:
-        pretrained = torch.load(model_path, map_location='cpu')
-    pretrained = {k: v for k, v in pretrained.items() if k in model_state_dict}
-    model_state_dict.update(pretrained)
-    model.load_state_dict(model_state_dict)
-    # torch.save(model.state_dict(), model_path.replace(".ckpt", "_nobn.ckpt"))
-    if torch.cuda.is_available():
-        model.cuda()
-    model.eval()
-    return model
+from douzero.env.features import get_obs
+from douzero.dmc.models import load_weights, detect_arch, load_model
 
 class DeepAgent:
 
     def __init__(self, position, model_path):
-        self.model_type = "general" if "resnet" in model_path else "old"
-        self.model = _load_model(position, model_path, self.model_type)
+        # The architecture is told by the weights, not the file name
+        arch = detect_arch(load_weights(model_path))
+        self.model_type = "old" if arch.startswith("lstm") else "general"
+        self.model = load_model(model_path, arch, 0 if torch.cuda.is_available() else "cpu")
         self.EnvCard2RealCard = {3: '3', 4: '4', 5: '5', 6: '6', 7: '7',
                             8: '8', 9: '9', 10: 'T', 11: 'J', 12: 'Q',
                             13: 'K', 14: 'A', 17: '2', 20: 'X', 30: 'D'}
@@ -36,6 +18,9 @@ class DeepAgent:
         if len(infoset.legal_actions) == 1:
             return infoset.legal_actions[0]
 
+        # The legacy encoders give z_batch as one history of shape
+        # (1, T, 162) for all the legal actions, which the LSTM
+        # models broadcast over x_batch
         obs = get_obs(infoset, self.model_type == "general")
 
         z_batch = torch.from_numpy(obs['z_batch']).float()
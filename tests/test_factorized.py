@@ -0,0 +1,110 @@
+"""
+The factorized first layer (--factorize_first_layer) against the
+plain forward of the models, on random decisions and on decisions
+recorded from seeded games.
+"""
+import pytest
+import torch
+
+from douzero.dmc.models import GeneralModel, MingpaiModel, factorized_conv1
+from douzero.dmc.export import sample_decisions
+
+TOLERANCE = 1e-5
+BATCH_SIZES = [1, 2, 7, 64, 300]
+MODELS = [
+    ('landlord', GeneralModel, 40),
+    ('landlord_up', MingpaiModel, 37),
+    ('landlord_down', MingpaiModel, 37),
+]
+
+
+def _model(cls):
+    """
+    An eval-mode model with random BatchNorm statistics, so that
+    the folded-in scale and shift are not the identity.
+    """
+    torch.manual_seed(0)
+    model = cls()
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 1.5)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+def _decision(num_actions, z_rows, generator):
+    """
+    The (z_batch, x_batch) of one random decision: the state rows
+    are shared by all the actions, only row 0 differs.
+    """
+    state = torch.randint(0, 2, (1, z_rows - 1, 54), generator=generator).float()
+    actions = torch.randint(0, 2, (num_actions, 1, 54), generator=generator).float()
+    z = torch.cat([actions, state.expand(num_actions, -1, -1)], dim=1)
+    x = torch.randint(0, 2, (1, 15), generator=generator).float().expand(num_actions, -1)
+    return z, x
+
+
+def _values(model, z, x, lengths=None):
+    with torch.no_grad():
+        plain = model.forward(z, x, True)['values']
+        factorized = model.forward_factorized(z, x, lengths, True)['values']
+    return plain, factorized
+
+
+@pytest.mark.parametrize('num_actions', BATCH_SIZES)
+@pytest.mark.parametrize('position,cls,z_rows', MODELS)
+def test_conv1_random_decision(position, cls, z_rows, num_actions):
+    model = _model(cls)
+    z, _ = _decision(num_actions, z_rows, torch.Generator().manual_seed(num_actions))
+    with torch.no_grad():
+        expected = model.conv1(z)
+        actual = factorized_conv1(model.conv1, z)
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('num_actions', BATCH_SIZES)
+@pytest.mark.parametrize('position,cls,z_rows', MODELS)
+def test_forward_random_decision(position, cls, z_rows, num_actions):
+    model = _model(cls)
+    z, x = _decision(num_actions, z_rows, torch.Generator().manual_seed(num_actions))
+    if cls is MingpaiModel:
+        x = torch.zeros(1)
+    plain, factorized = _values(model, z, x)
+    assert torch.allclose(factorized, plain, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('position,cls,z_rows', MODELS)
+def test_forward_concatenated_decisions(position, cls, z_rows):
+    """
+    Several decisions scored together, as VecEnvironment and the
+    inference server do.
+    """
+    model = _model(cls)
+    generator = torch.Generator().manual_seed(1)
+    decisions = [_decision(n, z_rows, generator) for n in (1, 5, 2, 33, 1)]
+    z = torch.cat([z for z, _ in decisions])
+    x = torch.cat([x for _, x in decisions]) if cls is GeneralModel else torch.zeros(1)
+    lengths = [z.shape[0] for z, _ in decisions]
+    plain, factorized = _values(model, z, x, lengths)
+    assert torch.allclose(factorized, plain, atol=TOLERANCE)
+
+
+@pytest.fixture(scope='module')
+def recorded():
+    return sample_decisions(num_games=2)
+
+
+@pytest.mark.parametrize('position,cls,z_rows', MODELS)
+def test_forward_recorded_decisions(recorded, position, cls, z_rows):
+    model = _model(cls)
+    assert len(recorded[position]) > 0
+    for z, x in recorded[position]:
+        plain, factorized = _values(model, z, x)
+        assert torch.allclose(factorized, plain, atol=TOLERANCE)
+    z = torch.cat([z for z, _ in recorded[position]])
+    x = torch.cat([x for _, x in recorded[position]]) if cls is GeneralModel else torch.zeros(1)
+    plain, factorized = _values(model, z, x, [z.shape[0] for z, _ in recorded[position]])
+    assert torch.allclose(factorized, plain, atol=TOLERANCE)
@@ -0,0 +1,67 @@
+"""
+The binary upload format (--upload_format binary) against the pickle
+format: decoding an encoded batch gives what unpacking a packed one
+gives.
+"""
+import json
+import struct
+
+import pytest
+import torch
+
+import client_helper
+from douzero.dmc.benchmark import record_upload_batches
+
+
+def _random_batch(generator, T=3, B=4):
+    return {
+        "done": torch.randint(0, 2, (T, B), generator=generator).bool(),
+        "episode_return": torch.randn(T, B, generator=generator),
+        "target": torch.randn(T, B, generator=generator),
+        "obs_x_batch": torch.randint(0, 2, (T, B, 15), generator=generator).to(torch.int8),
+        "obs_z": torch.randint(-1, 3, (T, B, 40, 54), generator=generator).to(torch.int8),
+        "obs_type": torch.randint(0, 3, (T, B), generator=generator).to(torch.int8),
+    }
+
+
+def _assert_same(expected, actual):
+    assert set(expected) == set(actual)
+    for key, value in expected.items():
+        assert actual[key].dtype == value.dtype, key
+        assert torch.equal(actual[key], value), key
+
+
+def _roundtrip(batches):
+    return client_helper.decode_batches(client_helper.encode_batches(batches, 7, '4.1.0', 'user'))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_random_batches(seed):
+    generator = torch.Generator().manual_seed(seed)
+    batches = [dict(position=position, batch=_random_batch(generator))
+               for position in ['landlord', 'landlord_up', 'landlord_down']]
+    info = _roundtrip(batches)
+    assert (info["model_version"], info["program_version"], info["username"]) == (7, '4.1.0', 'user')
+    assert [batch["position"] for batch in info["batches"]] == [batch["position"] for batch in batches]
+    for batch, decoded in zip(batches, info["batches"]):
+        _assert_same(client_helper.unpack_batch(client_helper.pack_batch(batch["batch"])), decoded["batch"])
+
+
+def test_recorded_batches():
+    batches = record_upload_batches(num_batches=1, unroll_length=4, batch_size=2)
+    for batch, decoded in zip(batches, _roundtrip(batches)["batches"]):
+        _assert_same(client_helper.unpack_batch(client_helper.pack_batch(batch["batch"])), decoded["batch"])
+
+
+def test_little_endian_dtypes():
+    generator = torch.Generator().manual_seed(0)
+    batch = _random_batch(generator)
+    data = client_helper.encode_batches([dict(position='landlord', batch=batch)], 0, '', '')
+    meta_len, = struct.unpack_from('<I', data, len(client_helper.WIRE_MAGIC))
+    start = len(client_helper.WIRE_MAGIC) + 4
+    fields = json.loads(data[start:start + meta_len])["batches"][0]["fields"]
+    assert [field["dtype"] for field in fields] == ['<i1', '<f4', '<f4', '<i1', '<i1', '<i1']
+    # episode_return follows the packed done bits
+    offset = start + meta_len + fields[0]["nbytes"]
+    expected = batch["episode_return"].numpy().astype('<f4').tobytes()
+    assert data[offset:offset + len(expected)] == expected
@@ -1,8 +1,14 @@
 import os
 
-from douzero.dmc import parser, train
+from douzero.dmc import parser, train, autotune, load_autotune, distill
 
 if __name__ == '__main__':
     flags = parser.parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = flags.gpu_devices
-    train(flags)
+    if flags.autotune:
+        autotune(flags)
+    elif flags.distill:
+        distill(flags)
+    else:
+        load_autotune(flags, parser)
+        train(flags)